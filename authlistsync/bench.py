@@ -0,0 +1,286 @@
+"""
+Scale benchmark for the auth list sync, run end to end against the fake MyGeotab server in fakegeotab.py.
+
+    python3 bench.py --groups 50 --vehicles 10000 --keys 1000 --latency 0.05
+
+Builds a synthetic fleet, runs main() for the initial load, applies a day of churn and runs main()
+again, then runs clear.py over every group. Each run is split into phases and for every phase the
+report shows wall time, API calls by method, bytes sent and received and time spent in SQLite.
+After every run each vehicle's auth list, replayed from the messages the server received, is checked
+against the keys it should have (none after clear.py); the benchmark exits with status 1 on any mismatch.
+Everything runs in a temporary directory, so authlist.db and the log of the real install are untouched.
+Extra settings for main.py can be passed with --env, e.g. --env INCREMENTAL_SYNC=True.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakegeotab
+
+
+class Recorder:
+    """Collects wall time, server stats and SQLite time for the phase that is currently running."""
+
+    def __init__(self, server):
+        self.server = server
+        self.current = None
+        self.phases = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def _entry(self, name):
+        if name not in self.phases:
+            self.phases[name] = {'wall': 0.0, 'sqlite': 0.0, 'requests': 0, 'calls': {}, 'bytes_out': 0, 'bytes_in': 0, 'over_limit': 0}
+            self.order.append(name)
+        return self.phases[name]
+
+    @contextmanager
+    def phase(self, name):
+        if self.current is not None:
+            # Nested stage: its cost is already counted by the outer phase
+            yield
+            return
+        before = _copy_stats(self.server.stats)
+        self.current = name
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - started
+            after = _copy_stats(self.server.stats)
+            with self.lock:
+                entry = self._entry(name)
+                entry['wall'] += elapsed
+                for field in ('requests', 'bytes_out', 'bytes_in', 'over_limit'):
+                    entry[field] += after[field] - before[field]
+                for method, count in after['calls'].items():
+                    delta = count - before['calls'].get(method, 0)
+                    if delta:
+                        entry['calls'][method] = entry['calls'].get(method, 0) + delta
+            self.current = None
+
+    def add_sqlite(self, seconds):
+        with self.lock:
+            self._entry(self.current or 'other')['sqlite'] += seconds
+
+
+def _copy_stats(stats):
+    copied = dict(stats)
+    copied['calls'] = dict(stats['calls'])
+    return copied
+
+
+recorder = None
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        started = perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            recorder.add_sqlite(perf_counter() - started)
+
+    def executemany(self, *args):
+        started = perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            recorder.add_sqlite(perf_counter() - started)
+
+    def fetchall(self):
+        started = perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            recorder.add_sqlite(perf_counter() - started)
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that adds the time of every statement and commit to the current phase."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        started = perf_counter()
+        try:
+            return super().commit()
+        finally:
+            recorder.add_sqlite(perf_counter() - started)
+
+    def __exit__(self, *args):
+        started = perf_counter()
+        try:
+            return super().__exit__(*args)
+        finally:
+            recorder.add_sqlite(perf_counter() - started)
+
+
+def instrument_sqlite():
+    connect = sqlite3.connect
+
+    def timed_connect(*args, **kwargs):
+        kwargs.setdefault('factory', TimedConnection)
+        return connect(*args, **kwargs)
+
+    sqlite3.connect = timed_connect
+
+
+def wrap(owner, name, phase_name):
+    """Replace owner.name with a version that runs inside a recorder phase."""
+    original = getattr(owner, name)
+    if isinstance(owner, type):
+        function = original.__func__
+
+        def wrapper(cls, *args, **kwargs):
+            with recorder.phase(phase_name):
+                return function(cls, *args, **kwargs)
+
+        setattr(owner, name, classmethod(wrapper))
+        return
+
+    def wrapper(*args, **kwargs):
+        with recorder.phase(phase_name(*args) if callable(phase_name) else phase_name):
+            return original(*args, **kwargs)
+
+    setattr(owner, name, wrapper)
+
+
+def instrument_main(main):
+    wrap(main, 'authenticate', 'authenticate')
+    wrap(main, 'sync_feed', 'feed sync')
+    wrap(main.FleetSnapshot, 'fetch', 'fleet snapshot')
+    wrap(main, 'search_texts', 'delivery reconciliation')
+    wrap(main, 'get_exception_users', 'exception users')
+    wrap(main, 'run_groups', lambda worker, *args: f"groups: {worker.__name__}")
+    wrap(main, 'plan_vehicles', 'plan vehicles')
+    wrap(main, 'execute_plan', 'execute plan')
+
+
+def count_log_errors(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as log:
+        return sum(1 for line in log if ' - ERROR - ' in line)
+
+
+def check_auth_lists(server, expected):
+    """The vehicles whose replayed auth list differs from what they should have, with their missing and extra keys."""
+    lists = fakegeotab.auth_lists(server)
+    return {
+        device_id: (len(keys - lists.get(device_id, set())), len(lists.get(device_id, set()) - keys))
+        for device_id, keys in expected.items() if lists.get(device_id, set()) != keys
+    }
+
+
+def run(label, function, server, results, expected=None):
+    global recorder
+    recorder = Recorder(server)
+    server.reset_stats()
+    started = perf_counter()
+    function()
+    total = perf_counter() - started
+    accounted = sum(entry['wall'] for entry in recorder.phases.values())
+    if total - accounted > 0.001:
+        recorder._entry('other')['wall'] += total - accounted
+    results.append({'run': label, 'wall': total, 'stats': _copy_stats(server.stats), 'phases': [dict(recorder.phases[name], phase=name) for name in recorder.order]})
+    if expected is not None:
+        mismatched = check_auth_lists(server, expected())
+        results[-1]['mismatched'] = len(mismatched)
+        for device_id, (missing, extra) in sorted(mismatched.items())[:10]:
+            print(f"{label}: vehicle {device_id} is missing {missing} keys and has {extra} extra")
+
+
+def print_report(results, errors):
+    for result in results:
+        stats = result['stats']
+        print(f"\n== {result['run']}: {result['wall']:.2f}s, {stats['requests']} requests, "
+              f"{stats['bytes_out'] / 1e6:.2f} MB sent, {stats['bytes_in'] / 1e6:.2f} MB received, {stats['over_limit']} over limit")
+        print(f"{'phase':<34}{'wall s':>9}{'sqlite s':>10}{'requests':>10}{'MB out':>9}{'MB in':>9}  calls")
+        for entry in result['phases']:
+            calls = ', '.join(f"{method}={count}" for method, count in sorted(entry['calls'].items()))
+            print(f"{entry['phase']:<34}{entry['wall']:>9.2f}{entry['sqlite']:>10.2f}{entry['requests']:>10}"
+                  f"{entry['bytes_out'] / 1e6:>9.2f}{entry['bytes_in'] / 1e6:>9.2f}  {calls}")
+        if 'mismatched' in result:
+            print(f"auth lists: {result['mismatched']} vehicles do not match their expected keys")
+    print(f"\nErrors logged: {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the auth list sync against a fake MyGeotab server.")
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--vehicles', type=int, default=500, help="vehicles across all groups")
+    parser.add_argument('--keys', type=int, default=50, help="driver keys per group")
+    parser.add_argument('--exception-keys', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='METHOD=PER_MINUTE', help="server side rate limit, repeatable")
+    parser.add_argument('--delivery-rate', type=float, default=0.9, help="chance a message is delivered by the next read")
+    parser.add_argument('--churn', type=float, default=0.01, help="fraction of drivers and vehicles changed before the second run")
+    parser.add_argument('--skip-clear', action='store_true', help="do not run clear.py at the end")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help="setting for main.py, repeatable")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    server = fakegeotab.install(fakegeotab.FakeMyGeotab(
+        latency=args.latency,
+        rate_limits={item.split('=')[0]: int(item.split('=')[1]) for item in args.rate_limit},
+        delivery_rate=args.delivery_rate,
+    ))
+    started = perf_counter()
+    group_names, exception_id = fakegeotab.generate_fleet(server, args.groups, args.vehicles, args.keys, args.exception_keys)
+    print(f"Generated {args.groups} groups, {len(server.entities['Device'])} vehicles, "
+          f"{len(server.entities['User'])} users in {perf_counter() - started:.1f}s")
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix='authlist-bench-')
+    os.chdir(workdir)
+    os.environ.update({
+        'GEOTAB_USERNAME': 'bench@example.com',
+        'GEOTAB_PASSWORD': 'bench',
+        'GEOTAB_DATABASE': 'bench',
+        'GEOTAB_GROUPS': ','.join(group_names),
+        'CLEAR_GEOTAB_GROUPS': ','.join(group_names),
+        'EXCEPTION_GROUP_ID': exception_id,
+    })
+    os.environ.update(dict(item.split('=', 1) for item in args.env))
+    instrument_sqlite()
+
+    import main as sync
+    instrument_main(sync)
+    def expected():
+        return fakegeotab.expected_auth_lists(server, group_names, exception_id)
+
+    results = []
+    run('initial load', sync.main, server, results, expected)
+    fakegeotab.churn(server, args.churn)
+    run(f"after {args.churn:.0%} churn", sync.main, server, results, expected)
+    if not args.skip_clear:
+        import clear
+        run('clear.py', clear.main, server, results, lambda: dict.fromkeys(server.entities['Device'], set()))
+
+    print_report(results, count_log_errors(os.path.join(workdir, sync.log_file_path)))
+    print(f"Working files left in {workdir}")
+    if json_path:
+        with open(json_path, 'w') as output:
+            json.dump(results, output, indent=2)
+    if any(result.get('mismatched') for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,111 +1,164 @@
-from mygeotab import API, dates
-from dotenv import load_dotenv
 import os
 import logging
-import sqlite3
+import threading
+from datetime import datetime, timezone
 
-# Load environment variables from .env file
-load_dotenv()
+# Shares main.py's rate limited client, multi_call queue, session renewal and database setup
+from main import (
+    RateLimitedAPI, PLAN_ADD, PLAN_PLANNED, PLAN_REMOVE, authenticate, clear_message, create_batcher, create_plan_table,
+    db_file, iterate_entities, metrics, property_selector, run_groups, stage,
+)
 
-# Get MyGeotab credentials and groups from environment variables
-username = os.getenv('GEOTAB_USERNAME')
-password = os.getenv('GEOTAB_PASSWORD')
-database = os.getenv('GEOTAB_DATABASE')
-group_names = os.getenv('CLEAR_GEOTAB_GROUPS', '').split(',')
-vehicle_names = os.getenv('CLEAR_GEOTAB_VEHICLES', '').split(',')
+# Get the groups and vehicles to clear from environment variables; the credentials are read by main.py
+group_names = [name for name in os.getenv('CLEAR_GEOTAB_GROUPS', '').split(',') if name]
+vehicle_names = [name for name in os.getenv('CLEAR_GEOTAB_VEHICLES', '').split(',') if name]
 
-db_file = 'authlist.db'
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+class ClearProgress:
+    """Vehicles queued, cleared and failed across every group, logged as each group finishes."""
 
-# Initialize the API connection
-api = API(username, password, database)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.cleared = 0
+        self.failed = 0
 
-def create_connection(db_file):
-    try:
-        conn = sqlite3.connect(db_file)
-        return conn
-    except sqlite3.Error as e:
-        logging.error(f"Error connecting to SQLite database: {e}")
-    return None
+    def queue(self, count):
+        with self.lock:
+            self.queued += count
 
-def clear_keys(conn, group_id):
-    try:
-        with conn:
-            c = conn.cursor()
-            c.execute(f"DELETE FROM keys_{group_id}")
-            logging.info(f"All keys removed for group {group_id}")
-    except sqlite3.Error as e:
-        logging.error(f"Error clearing keys for group {group_id}: {e}")
-
-def clear_vans(conn, group_id):
-    try:
-        with conn:
-            c = conn.cursor()
-            c.execute(f"DELETE FROM devices_{group_id}")
-            logging.info(f"All vans removed for group {group_id}")
-    except sqlite3.Error as e:
-        logging.error(f"Error clearing vans for group {group_id}: {e}")
-
-def send_text_message(api, vehicle_id):
-    "device": {
-        "id": vehicle_id
-    },
-    "isDirectionToVehicle": True,
-    "messageContent": {
-        "driverKey": None,
-        "contentType": "DriverAuthList",
-        "clearAuthList": False,
-        "addToAuthList": True
-    }
-        logging.info(f"Keys cleared from vehicle with ID: {vehicle_id}")
-    except Exception as e:
-        logging.error(f"Error sending text message to vehicle with ID: {vehicle_id}")
-
-def clear_group(api, group, db_file):
-    group_id = group['id']
-    conn = create_connection(db_file)
-    if conn:
-        clear_keys(conn, group_id)
-        clear_vans(conn, group_id)
-        
-        devices = get_vans_by_group(api, group_id, conn)
-        for device in devices:
-            send_clear_message(api, device['id'])
-        
-        conn.close()
+    def done(self, name, cleared, failed):
+        with self.lock:
+            self.cleared += cleared
+            self.failed += failed
+            logging.info(f"{name}: cleared {cleared} vehicles, {failed} failed ({self.cleared + self.failed} of {self.queued} queued so far)")
 
-def get_vans_by_group(api, group_id, conn):
-    try:
-        logging.info(f"Fetching devices for group ID: {group_id}")
-        devices = api.get('Device', search={'groups': [{'id': group_id}]})
-        
-        filtered_devices = []
-        for device in devices:
-            custom_parameters = device.get('customParameters', [])
-            for param in custom_parameters:
-                if param.get('description') == "Enable Authorised Driver List"
-                    filtered_devices.append(device)
-                    break
-        
-        if not filtered_devices:
-            logging.warning(f"No devices with 'Enable Authorised Driver List' enabled found in group ID: {group_id}")
-        
-        return filtered_devices
-    except Exception as e:
-        logging.error(f"Error fetching devices for group {group_id}: {e}")
-        return []
+def get_vans_by_group(api, group_id):
+    """Active vehicles in a group, child groups included, that have the authorized driver list enabled."""
+    logging.info(f"Fetching devices for group ID: {group_id}")
+    now_utc = datetime.now(timezone.utc)
+    device_ids = [
+        device['id'] for device in iterate_entities(api, 'Device', {'groups': [{'id': group_id}], "fromDate": now_utc})
+        if any(param.get('description') == "Enable Authorised Driver List" for param in device.get('customParameters', []))
+    ]
+    if not device_ids:
+        logging.warning(f"No devices with 'Enable Authorised Driver List' enabled found in group ID: {group_id}")
+    return device_ids
+
+def get_vans_by_name(batcher, names):
+    """Ids of the active vehicles with the given names, looked up in batched Get calls."""
+    now_utc = datetime.now(timezone.utc)
+    futures = [(name, batcher.submit(['Get', {"typeName": 'Device', "search": {'name': name, "fromDate": now_utc},
+                                              "propertySelector": property_selector('Device')}])) for name in names]
+    device_ids = []
+    for name, future in futures:
+        try:
+            devices = future.result()
+        except Exception as e:
+            logging.error(f"Error fetching vehicle {name}: {e}")
+            continue
+        if not devices:
+            logging.warning(f"No active vehicle named {name}")
+        device_ids += [device['id'] for device in devices]
+    return device_ids
+
+def send_clear_messages(batcher, device_ids, retries=2):
+    """
+    Clear the authorization list of many vehicles through the shared multi_call queue.
+
+    Every vehicle's clearAuthList message is queued at once, so the batcher packs messages from all
+    groups into full multi_calls. Vehicles whose message failed are queued again, up to `retries` rounds.
+
+    Parameters:
+    batcher (MultiCallBatcher): The shared send queue.
+    device_ids (list): The vehicles to clear.
+    retries (int): How many rounds of resending the failed vehicles. Default is 2.
+
+    Returns:
+    tuple: The ids of the vehicles cleared and of those that still failed.
+    """
+    remaining = list(dict.fromkeys(device_ids))
+    cleared = []
+    errors = {}
+    for attempt in range(retries):
+        futures = [(device_id, batcher.submit(['Add', {"typeName": 'TextMessage', "entity": clear_message(device_id)}])) for device_id in remaining]
+        failed = []
+        for device_id, future in futures:
+            try:
+                future.result()
+                cleared.append(device_id)
+            except Exception as e:
+                errors[device_id] = e
+                failed.append(device_id)
+        if failed and attempt < retries - 1:
+            logging.warning(f"Retrying {len(failed)} of {len(remaining)} clears")
+            metrics.retry('clear', len(failed))
+        remaining = failed
+        if not remaining:
+            break
+    for device_id in remaining:
+        logging.error(f"Error clearing vehicle with ID: {device_id}: {errors[device_id]}")
+    return cleared, remaining
+
+def clear_group(credentials, group, batcher, progress):
+    """Worker: clear every vehicle in a group that has the authorized driver list enabled. Returns the cleared ids."""
+    api = RateLimitedAPI.from_credentials(credentials)
+    metrics.group(group['name'])
+    device_ids = get_vans_by_group(api, group['id'])
+    progress.queue(len(device_ids))
+    cleared, failed = send_clear_messages(batcher, device_ids)
+    progress.done(group['name'], len(cleared), len(failed))
+    return cleared
+
+def forget_vehicles(conn, device_ids):
+    """
+    Drop what authlist.db knows about the cleared vehicles, in one transaction.
+
+    Their rows in every devices_ table, their key states and the key operations still planned for
+    them go, so the next main.py run sees them as new vehicles and sends their full lists. The keys_
+    tables are left alone: they are the groups' keys, which the vehicles not cleared still have.
+    """
+    create_plan_table(conn)
+    with conn:
+        stage(conn, 'staged_ids', "id TEXT PRIMARY KEY", [(device_id,) for device_id in device_ids])
+        tables = [row[0] for row in conn.execute(r"SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'devices\_%' ESCAPE '\'")]
+        for table in tables:
+            conn.execute(f"DELETE FROM {table} WHERE deviceId IN (SELECT id FROM temp.staged_ids)")
+        conn.execute("DELETE FROM key_device_status WHERE device_id IN (SELECT id FROM temp.staged_ids)")
+        conn.execute('''
+            DELETE FROM sync_plan WHERE status = ? AND action IN (?, ?) AND device_id IN (SELECT id FROM temp.staged_ids)
+        ''', (PLAN_PLANNED, PLAN_ADD, PLAN_REMOVE))
+    logging.info(f"Removed {len(device_ids)} cleared vehicles from {db_file}")
 
 def main():
     try:
-        api.authenticate()
-        groups = api.get('Group', search=dict(active=True))
-        filtered_groups = [group for group in groups if group['name'] in group_names]
-        
-        for group in filtered_groups:
-            clear_group(api, group, db_file)
-            
+        api, conn, credentials = authenticate(db_file)
+        progress = ClearProgress()
+        batcher = create_batcher(api)
+        try:
+            groups = api.get('Group', search=dict(active=True))
+            filtered_groups = [group for group in groups if group['name'] in group_names]
+            # Groups are fetched concurrently and all of their clears share one queue
+            cleared_by_group = run_groups(clear_group, filtered_groups, credentials, batcher, progress)
+            cleared = [device_id for device_ids in cleared_by_group.values() for device_id in device_ids]
+            if vehicle_names:
+                already_cleared = set(cleared)
+                vehicle_ids = [device_id for device_id in get_vans_by_name(batcher, vehicle_names) if device_id not in already_cleared]
+                progress.queue(len(vehicle_ids))
+                vehicles_cleared, vehicles_failed = send_clear_messages(batcher, vehicle_ids)
+                progress.done("CLEAR_GEOTAB_VEHICLES", len(vehicles_cleared), len(vehicles_failed))
+                cleared += vehicles_cleared
+        finally:
+            batcher.close()
+        # Only vehicles whose clear was accepted are forgotten; failed ones keep their state for a retry
+        forget_vehicles(conn, cleared)
+        logging.info(f"Cleared {progress.cleared} vehicles, {progress.failed} failed")
+        conn.close()
     except Exception as e:
         logging.error(f"Error in main process: {e}")
 
 if __name__ == "__main__":
+    # main.py logs to authlistlog.txt; show the progress on the console as well
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logging.getLogger().addHandler(console)
     main()
@@ -0,0 +1,445 @@
+"""
+A local stand-in for a MyGeotab server, used to measure the sync without a live database.
+
+install() swaps the transport inside the mygeotab package (mygeotab.api._query and its asyncio
+counterpart mygeotab.api_async._query) for an in-process one,
+so main.py and clear.py run unchanged: every request is serialized with the mygeotab serializers,
+handled by FakeMyGeotab and the response deserialized again, the same round trip as over HTTP minus
+the network. Latency and per-method rate limits are configurable, and every request is counted
+with its size so the benchmark can report API calls and bytes transferred. Get and GetFeed honour
+propertySelector, and Set replaces the stored entity, so a Set of a partial entity shows up as lost fields. Sessions are checked like
+the real server does, and expire_sessions() makes every open session invalid.
+
+Supported methods: Authenticate, Get (Group, User, Device, TextMessage), Set, Add, ExecuteMultiCall
+and GetFeed.
+"""
+import asyncio
+import random
+import threading
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from time import monotonic, sleep
+
+import mygeotab.api
+import mygeotab.api_async
+from mygeotab.serializers import json_deserialize, json_serialize
+
+MAX_DATE = datetime(2050, 1, 1, tzinfo=timezone.utc)
+MIN_DATE = datetime(1986, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeServerError(Exception):
+    """An error the fake server returns in the JSON-RPC error body, like MyGeotab does."""
+
+    def __init__(self, name, message):
+        super().__init__(message)
+        self.name = name
+        self.message = message
+
+
+class FakeMyGeotab:
+    """
+    In-memory MyGeotab database.
+
+    Parameters:
+    latency (float): Seconds every request takes, spent outside the server lock so concurrent callers overlap.
+    rate_limits (dict): Calls per minute per method; going over returns OverLimitException.
+    delivery_rate (float): Chance that a new TextMessage is already delivered the next time it is read.
+    """
+
+    def __init__(self, latency=0.0, rate_limits=None, delivery_rate=1.0, seed=1):
+        self.latency = latency
+        self.rate_limits = rate_limits or {}
+        self.delivery_rate = delivery_rate
+        self.random = random.Random(seed)
+        self.entities = {'Group': {}, 'User': {}, 'Device': {}, 'TextMessage': {}}
+        self.versions = {}
+        self.version = 0
+        self.lock = threading.RLock()
+        self.calls = deque()
+        self.sessions = set()
+        self.stats = {'requests': 0, 'calls': {}, 'bytes_out': 0, 'bytes_in': 0, 'over_limit': 0}
+
+    # Data ###################################################################################################
+
+    def put(self, type_name, entity):
+        with self.lock:
+            self.version += 1
+            self.entities[type_name][entity['id']] = entity
+            self.versions[(type_name, entity['id'])] = self.version
+
+    def children(self, group_id):
+        found = {group_id}
+        stack = [group_id]
+        while stack:
+            group = self.entities['Group'].get(stack.pop())
+            for child in (group or {}).get('children', []):
+                if child['id'] not in found:
+                    found.add(child['id'])
+                    stack.append(child['id'])
+        return found
+
+    def _matches(self, type_name, entity, search):
+        if not search:
+            return True
+        if 'id' in search and entity['id'] != search['id']:
+            return False
+        if 'name' in search and entity.get('name') != search['name']:
+            return False
+        if 'fromDate' in search and type_name in ('User', 'Device'):
+            if entity.get('activeTo', MAX_DATE) < _as_date(search['fromDate']):
+                return False
+        if 'fromDate' in search and type_name == 'TextMessage':
+            if entity['sent'] < _as_date(search['fromDate']):
+                return False
+        if search.get('isDriver') is not None and entity.get('isDriver', False) != search['isDriver']:
+            return False
+        for field in ('groups', 'companyGroups'):
+            if field in search:
+                wanted = set()
+                for group in search[field]:
+                    wanted |= self.children(group['id'])
+                if not any(group['id'] in wanted for group in entity.get(field, [])):
+                    return False
+        if 'contentTypes' in search:
+            if entity.get('messageContent', {}).get('contentType') not in search['contentTypes']:
+                return False
+        if 'deviceSearch' in search and not self._matches('Device', self.entities['Device'].get(entity['device']['id'], {}), search['deviceSearch']):
+            return False
+        return True
+
+    def _deliver(self, message):
+        """Deliver a pending message with probability delivery_rate, as if its vehicle checked in."""
+        if message['delivered'] == MIN_DATE and self.random.random() < self.delivery_rate:
+            message['delivered'] = datetime.now(timezone.utc)
+            self.put('TextMessage', message)
+
+    # Methods ################################################################################################
+
+    def authenticate(self, params):
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions.add(session_id)
+        return {
+            'path': 'ThisServer',
+            'credentials': {'userName': params.get('userName'), 'sessionId': session_id, 'database': params.get('database')},
+        }
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def get(self, params):
+        type_name = params['typeName']
+        search = params.get('search') or {}
+        with self.lock:
+            if type_name == 'TextMessage':
+                for message in list(self.entities['TextMessage'].values()):
+                    self._deliver(message)
+            results = [entity for entity in self.entities[type_name].values() if self._matches(type_name, entity, search)]
+            sort = params.get('sort')
+            if sort:
+                field = sort.get('sortBy', 'id')
+                results.sort(key=lambda entity: str(entity.get(field)))
+                if sort.get('offset') is not None:
+                    results = [entity for entity in results if str(entity.get(field)) > str(sort['offset'])]
+            if params.get('resultsLimit'):
+                results = results[:params['resultsLimit']]
+            return [_select(entity, params.get('propertySelector')) for entity in results]
+
+    def get_feed(self, params):
+        type_name = params['typeName']
+        limit = params.get('resultsLimit') or 50000
+        with self.lock:
+            if type_name == 'TextMessage':
+                for message in list(self.entities['TextMessage'].values()):
+                    self._deliver(message)
+            from_version = int(params['fromVersion']) if params.get('fromVersion') is not None else None
+            changed = sorted(
+                (version, entity_id) for (name, entity_id), version in self.versions.items()
+                if name == type_name and (from_version is None or version > from_version)
+            )
+            data = []
+            to_version = from_version or 0
+            for version, entity_id in changed:
+                entity = self.entities[type_name][entity_id]
+                to_version = version
+                if from_version is None and not self._matches(type_name, entity, params.get('search')):
+                    continue
+                data.append(_select(entity, params.get('propertySelector')))
+                if len(data) >= limit:
+                    break
+            if len(data) < limit:
+                to_version = max(to_version, self.version)
+            return {'data': data, 'toVersion': str(to_version)}
+
+    def set(self, params):
+        type_name = params['typeName']
+        entity = params['entity']
+        with self.lock:
+            if entity['id'] not in self.entities[type_name]:
+                raise FakeServerError('InvalidOperationException', f"{type_name} {entity['id']} does not exist")
+            # Like MyGeotab, Set replaces the whole entity: properties left out of it are lost
+            self.put(type_name, dict(entity))
+        return None
+
+    def add(self, params):
+        type_name = params['typeName']
+        entity = dict(params['entity'])
+        if type_name != 'TextMessage':
+            raise FakeServerError('InvalidOperationException', f"Add {type_name} is not supported by the fake server")
+        content = entity.get('messageContent', {})
+        if content.get('clearAuthList') and content.get('driverKey') is not None:
+            raise FakeServerError('ArgumentException', "driverKey must be null when clearing the auth list")
+        with self.lock:
+            if entity['device']['id'] not in self.entities['Device']:
+                raise FakeServerError('InvalidOperationException', f"Device {entity['device']['id']} does not exist")
+            entity['id'] = 'a' + uuid.uuid4().hex[:12]
+            entity['sent'] = datetime.now(timezone.utc)
+            entity['delivered'] = MIN_DATE
+            self.put('TextMessage', entity)
+        return entity['id']
+
+    def multi_call(self, params):
+        return [self.dispatch(call['method'], call.get('params', {})) for call in params['calls']]
+
+    def dispatch(self, method, params):
+        handler = {
+            'Authenticate': self.authenticate,
+            'Get': self.get,
+            'GetFeed': self.get_feed,
+            'Set': self.set,
+            'Add': self.add,
+            'ExecuteMultiCall': self.multi_call,
+        }.get(method)
+        if handler is None:
+            raise FakeServerError('MissingMethodException', f"The method '{method}' could not be found")
+        return handler(params)
+
+    # Transport ##############################################################################################
+
+    def _check_rate(self, method):
+        limit = self.rate_limits.get(method)
+        if not limit:
+            return
+        with self.lock:
+            now = monotonic()
+            while self.calls and self.calls[0][0] < now - 60:
+                self.calls.popleft()
+            if sum(1 for _, name in self.calls if name == method) >= limit:
+                self.stats['over_limit'] += 1
+                raise FakeServerError('OverLimitException', f"API calls quota exceeded. Maximum admitted {limit} per 1m.")
+            self.calls.append((now, method))
+
+    def request(self, method, parameters):
+        """Handle one serialized JSON-RPC request and return the serialized response."""
+        if self.latency:
+            sleep(self.latency)
+        return self.handle(method, parameters)
+
+    def handle(self, method, parameters):
+        """The request without its latency, for callers that wait it out themselves."""
+        body = json_serialize(dict(id=-1, method=method, params=parameters or {}))
+        params = json_deserialize(body)['params']
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['bytes_out'] += len(body)
+            inner = params['calls'] if method == 'ExecuteMultiCall' else [{'method': method, 'params': params}]
+            for call in inner:
+                name = f"{call['method']} {call.get('params', {}).get('typeName', '')}".strip()
+                self.stats['calls'][name] = self.stats['calls'].get(name, 0) + 1
+            if method == 'ExecuteMultiCall':
+                self.stats['calls']['ExecuteMultiCall'] = self.stats['calls'].get('ExecuteMultiCall', 0) + 1
+        try:
+            self._check_rate(method)
+            if method != 'Authenticate' and params.get('credentials', {}).get('sessionId') not in self.sessions:
+                raise FakeServerError('InvalidUserException', "Incorrect login credentials")
+            response = json_serialize({'result': self.dispatch(method, params), 'jsonrpc': '2.0'})
+        except FakeServerError as e:
+            response = json_serialize({'error': {'errors': [{'name': e.name, 'message': e.message}]}, 'jsonrpc': '2.0'})
+        with self.lock:
+            self.stats['bytes_in'] += len(response)
+        return response
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'calls': {}, 'bytes_out': 0, 'bytes_in': 0, 'over_limit': 0}
+
+
+def _as_date(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _select(entity, property_selector):
+    if not property_selector or not property_selector.get('fields'):
+        return entity
+    fields = set(property_selector['fields'])
+    if property_selector.get('isIncluded', True):
+        return {name: value for name, value in entity.items() if name in fields or name == 'id'}
+    return {name: value for name, value in entity.items() if name not in fields}
+
+
+def install(server):
+    """Route every mygeotab call in this process to server instead of over HTTP."""
+
+    def _query(server_name, method, parameters, timeout=None, verify_ssl=True, proxies=None, cert=None):
+        return mygeotab.api._process(json_deserialize(server.request(method, parameters)))
+
+    async def _query_async(server_name, method, parameters, timeout=None, verify_ssl=True, cert=None):
+        # The latency is awaited, so concurrent coroutines overlap like requests in flight over HTTP
+        if server.latency:
+            await asyncio.sleep(server.latency)
+        return mygeotab.api._process(json_deserialize(server.handle(method, parameters)))
+
+    mygeotab.api._query = _query
+    mygeotab.api_async._query = _query_async
+    return server
+
+
+def generate_fleet(server, groups=50, vehicles=10000, keys_per_group=1000, exception_keys=10, seed=1):
+    """
+    Fill server with a synthetic fleet.
+
+    Every group gets an equal share of the vehicles and keys_per_group drivers with one NFC key each.
+    Each group has a child depot group holding half of its vehicles, so group membership has to be
+    resolved through the group tree. An exception group holds exception_keys mechanics that are not drivers.
+
+    Returns:
+    tuple: The group names, for GEOTAB_GROUPS, and the exception group id.
+    """
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    names = []
+    root_children = []
+    device_number = 0
+    user_number = 0
+    per_group = max(1, vehicles // groups)
+    for group_number in range(1, groups + 1):
+        group_id = f"b{group_number:X}0"
+        depot_id = f"b{group_number:X}1"
+        name = f"Group {group_number}"
+        names.append(name)
+        root_children.append({'id': group_id})
+        server.put('Group', {'id': group_id, 'name': name, 'children': [{'id': depot_id}]})
+        server.put('Group', {'id': depot_id, 'name': f"{name} Depot", 'children': []})
+        for index in range(per_group):
+            device_number += 1
+            server.put('Device', {
+                'id': f"b{device_number:X}",
+                'name': f"Van {device_number}",
+                'serialNumber': f"G9{device_number:010d}",
+                'groups': [{'id': depot_id if index % 2 else group_id}],
+                'activeFrom': now - timedelta(days=365),
+                'activeTo': MAX_DATE,
+                'customParameters': [],
+                'timeZoneId': 'America/Vancouver',
+            })
+        for _ in range(keys_per_group):
+            user_number += 1
+            server.put('User', _driver(user_number, group_id, now, rng))
+    exception_id = 'bEXC'
+    server.put('Group', {'id': exception_id, 'name': 'Exceptions', 'children': []})
+    for _ in range(exception_keys):
+        user_number += 1
+        user = _driver(user_number, exception_id, now, rng)
+        user['isDriver'] = False
+        server.put('User', user)
+    server.put('Group', {'id': 'GroupCompanyId', 'name': 'Company', 'children': root_children + [{'id': exception_id}]})
+    return names, exception_id
+
+
+def _driver(number, group_id, now, rng):
+    return {
+        'id': f"u{number}",
+        'name': f"driver{number}@example.com",
+        'isDriver': True,
+        'activeFrom': now - timedelta(days=365),
+        'activeTo': MAX_DATE,
+        'companyGroups': [{'id': group_id}],
+        'keys': [{
+            'driverKeyType': 'CustomNfc',
+            'id': f"k{number}",
+            'keyId': f"k{number}",
+            'serialNumber': f"{rng.getrandbits(56):014X}",
+        }],
+        'timezoneid': 'America/Vancouver',
+        'securityGroups': [{'id': 'GroupEverythingSecurityId'}],
+    }
+
+
+def auth_lists(server):
+    """Replay every DriverAuthList message in the order it was sent and return the keys each vehicle ends up with."""
+    lists = {}
+    with server.lock:
+        messages = list(server.entities['TextMessage'].values())
+    for message in messages:
+        content = message.get('messageContent', {})
+        if content.get('contentType') != 'DriverAuthList':
+            continue
+        keys = lists.setdefault(message['device']['id'], set())
+        if content.get('clearAuthList'):
+            keys.clear()
+        elif content.get('addToAuthList'):
+            keys.add(content['driverKey']['serialNumber'])
+        else:
+            keys.discard(content['driverKey']['serialNumber'])
+    return lists
+
+
+def expected_auth_lists(server, group_names, exception_group_id):
+    """
+    The keys every vehicle should end up with, by the sync's rules, to check auth_lists() against.
+
+    A vehicle in (a child of) one or more of the synced groups should have the keys of the active drivers
+    in those groups and their children, plus the keys of every active user in the exception group. A vehicle
+    in none of them should have an empty list.
+    """
+    now = datetime.now(timezone.utc)
+    with server.lock:
+        roots = {group['name']: group['id'] for group in server.entities['Group'].values() if group['name'] in group_names}
+        trees = {root: server.children(root) for root in roots.values()}
+        users = [user for user in server.entities['User'].values() if user.get('activeTo', MAX_DATE) > now]
+        devices = list(server.entities['Device'].values())
+    exception_keys = {key['serialNumber'] for user in users
+                      if any(group['id'] == exception_group_id for group in user.get('companyGroups', []))
+                      for key in user.get('keys', [])}
+    driver_keys = {}
+    for user in users:
+        if not user.get('isDriver'):
+            continue
+        for group in user.get('companyGroups', []):
+            for key in user.get('keys', []):
+                driver_keys.setdefault(group['id'], set()).add(key['serialNumber'])
+    expected = {}
+    for device in devices:
+        device_groups = {group['id'] for group in device.get('groups', [])}
+        synced = [tree for tree in trees.values() if device_groups & tree]
+        keys = set()
+        for tree in synced:
+            for group_id in tree:
+                keys |= driver_keys.get(group_id, set())
+        expected[device['id']] = keys | exception_keys if synced else set()
+    return expected
+
+
+def churn(server, fraction=0.01, seed=2):
+    """Simulate a day of changes: retire and hire a fraction of the drivers and move a fraction of the vehicles."""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    with server.lock:
+        drivers = [user for user in server.entities['User'].values() if user.get('isDriver') and user.get('activeTo', MAX_DATE) > now]
+        devices = list(server.entities['Device'].values())
+        groups = sorted({user['companyGroups'][0]['id'] for user in drivers})
+        next_user = len(server.entities['User']) + 1
+    for user in rng.sample(drivers, int(len(drivers) * fraction)):
+        retired = dict(user, activeTo=now - timedelta(minutes=1))
+        server.put('User', retired)
+        server.put('User', _driver(next_user, rng.choice(groups), now, rng))
+        next_user += 1
+    for device in rng.sample(devices, int(len(devices) * fraction)):
+        server.put('Device', dict(device, groups=[{'id': rng.choice(groups)}]))
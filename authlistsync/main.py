@@ -1,10 +1,26 @@
-from mygeotab import API,MyGeotabException
+from mygeotab import API,MyGeotabException,AuthenticationException
+from mygeotab import api_async
+from mygeotab.serializers import json_serialize, json_deserialize
+from requests.exceptions import HTTPError
+import aiohttp
 from dotenv import load_dotenv
 import os
+import copy
+import shutil
+import argparse
+import asyncio
+import tempfile
 import logging
 import sqlite3
-from time import sleep
-from datetime import datetime,timezone
+import json
+import random
+import signal
+import threading
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from time import sleep, monotonic, perf_counter, time
+from datetime import datetime,timezone,timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 #import json
 # Load environment variables from .env file
 load_dotenv()
@@ -19,27 +35,469 @@ username = os.getenv('GEOTAB_USERNAME')
 password = os.getenv('GEOTAB_PASSWORD')
 database = os.getenv('GEOTAB_DATABASE')
 group_names = os.getenv('GEOTAB_GROUPS', '').split(',')
-db_file = 'authlist.db'
+# Timezone for each group's users and vehicles, from a line per group, e.g. Group Vancouver=America/Vancouver
+group_timezones = {name: os.getenv(name, 'America/Vancouver') for name in group_names}
+db_file = os.getenv('DB_FILE', 'authlist.db')
 patch_users = os.getenv('PATCH_USERS', 'False')
 patch_assets = os.getenv('PATCH_ASSETS', 'False')
 patch_tz = os.getenv('PATCH_TZ', False)
 patch_sc = os.getenv('PATCH_SC', False)
 new_scid = os.getenv('NEW_SC_ID', None)
-old_scid = os.getenv('OLD_SC_ID', None).split(',')
+old_scid = os.getenv('OLD_SC_ID', '').split(',')
 exception_group_id=os.getenv('EXCEPTION_GROUP_ID', None)
+group_concurrency = int(os.getenv('GROUP_CONCURRENCY', 4))
+multicall_batch_size = int(os.getenv('MULTICALL_BATCH_SIZE', 50))
+multicall_max_wait = float(os.getenv('MULTICALL_MAX_WAIT', 0.5))
+# Multi_calls sent at the same time with the asyncio client; 0 sends them one at a time from a thread
+async_in_flight = int(os.getenv('ASYNC_IN_FLIGHT', 0))
+incremental_sync = os.getenv('INCREMENTAL_SYNC', 'False').lower() == 'true'
+full_resync = os.getenv('FULL_RESYNC', 'False').lower() == 'true'
+feed_results_limit = int(os.getenv('FEED_RESULTS_LIMIT', 5000))
+# Users and Devices are fetched and processed this many at a time
+entity_page_size = int(os.getenv('ENTITY_PAGE_SIZE', 5000))
+use_fleet_snapshot = os.getenv('FLEET_SNAPSHOT', 'True').lower() == 'true'
+# Calls per minute for each API method, e.g. RATE_LIMITS=Get=600,ExecuteMultiCall=300
+rate_limits = dict(item.split('=') for item in os.getenv('RATE_LIMITS', 'Get=600,GetFeed=600,Set=600,Add=600,ExecuteMultiCall=300').split(',') if item)
+default_rate_limit = float(os.getenv('DEFAULT_RATE_LIMIT', 600))
+api_retries = int(os.getenv('API_RETRIES', 5))
+delivery_timeout_days = float(os.getenv('DELIVERY_TIMEOUT_DAYS', 7))
+delivery_lookback_days = float(os.getenv('DELIVERY_LOOKBACK_DAYS', 7))
+# key_device_status.state: unsent or failed (plan_vehicles resends it), sent and waiting on the vehicle, confirmed delivered
+KEY_STATE_UNSENT = 0
+KEY_STATE_PENDING = 1
+KEY_STATE_DELIVERED = 2
+# Exception keys are kept in keys_exceptions, apart from the group key tables
+EXCEPTION_KEYS = 'exceptions'
+plan_chunk_size = int(os.getenv('PLAN_CHUNK_SIZE', 5000))
+plan_max_attempts = int(os.getenv('PLAN_MAX_ATTEMPTS', 5))
+# Share of each chunk of the plan given to each kind of operation while more than one kind is waiting, see execute_plan
+plan_shares = {name: float(share) for name, share in (item.split('=') for item in os.getenv('PLAN_SHARES', 'new_key=8,remove=4,retry=2,full_load=1').split(',') if item)}
+# Clear a vehicle's auth list and send every key again when that takes fewer messages than the individual changes
+allow_rebuild = os.getenv('ALLOW_REBUILD', 'True').lower() == 'true'
+# Set by main(dry_run_only=True): work out the plan but make no API writes
+dry_run = False
+# Run summary for monitoring: a .prom path is written in Prometheus textfile format, anything else as JSON
+metrics_file = os.getenv('METRICS_FILE', 'authlist_metrics.json')
+# Daemon mode (--daemon): default seconds between syncs of a group, per group overrides e.g. GROUP_INTERVALS=Group A=120,Group B=900,
+# how often the Group list is reloaded and the local port of the health/status endpoint (0 turns it off)
+daemon_interval = float(os.getenv('DAEMON_INTERVAL', 300))
+group_intervals = {name: float(seconds) for name, seconds in (item.rsplit('=', 1) for item in os.getenv('GROUP_INTERVALS', '').split(',') if '=' in item)}
+group_refresh_interval = float(os.getenv('GROUP_REFRESH_INTERVAL', 3600))
+status_port = int(os.getenv('STATUS_PORT', 8765))
+# Child group ids for every group, filled from the Group list at the start of a run
+group_tree = {}
+# All active drivers and devices for this run when FLEET_SNAPSHOT is on, see FleetSnapshot
+fleet_snapshot = None
 now = datetime.now()
 
 
 
+###Metrics ##################################################################################################################################################
+class RunMetrics:
+    """
+    Counters and timings for one run, written out by write_metrics at the end of main().
+
+    Phases are timed by the @instrumented decorator, per group when the worker thread has set one with
+    group(). API calls are counted by method and entity type in RateLimitedAPI, multi_call batch sizes
+    in MultiCallBatcher, and retries wherever a retry happens. A phase that returns a list adds its
+    length to the rows touched, which covers the SQLite helpers. Latencies are the time from planning an
+    operation to sending it and to its delivery, per kind of operation.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time()
+            self.phases = {}
+            self.api_calls = {}
+            self.batches = {'count': 0, 'calls': 0, 'max': 0}
+            self.retries = {}
+            self.rows = {}
+            self.latencies = {}
+            self.errors = 0
+
+    def group(self, group_name):
+        self.local.group = group_name
+
+    def phase(self, name, seconds, rows=None):
+        key = (name, getattr(self.local, 'group', None) or '')
+        with self.lock:
+            entry = self.phases.setdefault(key, {'calls': 0, 'seconds': 0.0})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            if rows is not None:
+                self.rows[name] = self.rows.get(name, 0) + rows
+
+    def api_call(self, method, type_name, seconds):
+        key = (method, type_name or '')
+        with self.lock:
+            entry = self.api_calls.setdefault(key, {'calls': 0, 'seconds': 0.0})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+
+    def batch(self, size):
+        with self.lock:
+            self.batches['count'] += 1
+            self.batches['calls'] += size
+            self.batches['max'] = max(self.batches['max'], size)
+
+    def retry(self, kind, count=1):
+        with self.lock:
+            self.retries[kind] = self.retries.get(kind, 0) + count
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+    def latency(self, name, seconds):
+        with self.lock:
+            entry = self.latencies.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+
+    def summary(self):
+        with self.lock:
+            return {
+                'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                'duration_seconds': round(time() - self.started, 3),
+                'phases': [dict(phase=name, group=group, **entry) for (name, group), entry in sorted(self.phases.items())],
+                'api_calls': [dict(method=method, type=type_name, **entry) for (method, type_name), entry in sorted(self.api_calls.items())],
+                'multicall_batches': dict(self.batches),
+                'retries': dict(self.retries),
+                'rows': dict(self.rows),
+                'latencies': [dict(name=name, count=entry['count'], mean=round(entry['seconds'] / entry['count'], 3), max=round(entry['max'], 3))
+                              for name, entry in sorted(self.latencies.items())],
+                'errors': self.errors,
+            }
+
+    def prometheus(self):
+        summary = self.summary()
+        lines = [
+            '# TYPE authlist_run_duration_seconds gauge',
+            f"authlist_run_duration_seconds {summary['duration_seconds']}",
+            '# TYPE authlist_run_timestamp_seconds gauge',
+            f"authlist_run_timestamp_seconds {self.started:.0f}",
+            '# TYPE authlist_run_errors gauge',
+            f"authlist_run_errors {summary['errors']}",
+            '# TYPE authlist_phase_seconds gauge',
+        ]
+        lines += [f'authlist_phase_seconds{{phase="{p["phase"]}",group="{_label(p["group"])}"}} {p["seconds"]:.3f}' for p in summary['phases']]
+        lines.append('# TYPE authlist_phase_calls gauge')
+        lines += [f'authlist_phase_calls{{phase="{p["phase"]}",group="{_label(p["group"])}"}} {p["calls"]}' for p in summary['phases']]
+        lines.append('# TYPE authlist_api_calls gauge')
+        lines += [f'authlist_api_calls{{method="{c["method"]}",type="{c["type"]}"}} {c["calls"]}' for c in summary['api_calls']]
+        lines.append('# TYPE authlist_api_seconds gauge')
+        lines += [f'authlist_api_seconds{{method="{c["method"]}",type="{c["type"]}"}} {c["seconds"]:.3f}' for c in summary['api_calls']]
+        lines.append('# TYPE authlist_multicall_batches gauge')
+        lines.append(f"authlist_multicall_batches {summary['multicall_batches']['count']}")
+        lines.append('# TYPE authlist_multicall_batched_calls gauge')
+        lines.append(f"authlist_multicall_batched_calls {summary['multicall_batches']['calls']}")
+        lines.append('# TYPE authlist_multicall_batch_size_max gauge')
+        lines.append(f"authlist_multicall_batch_size_max {summary['multicall_batches']['max']}")
+        lines.append('# TYPE authlist_retries gauge')
+        lines += [f'authlist_retries{{kind="{kind}"}} {count}' for kind, count in sorted(summary['retries'].items())]
+        lines.append('# TYPE authlist_rows gauge')
+        lines += [f'authlist_rows{{phase="{name}"}} {count}' for name, count in sorted(summary['rows'].items())]
+        lines.append('# TYPE authlist_latency_seconds_mean gauge')
+        lines += [f'authlist_latency_seconds_mean{{name="{_label(entry["name"])}"}} {entry["mean"]}' for entry in summary['latencies']]
+        lines.append('# TYPE authlist_latency_seconds_max gauge')
+        lines += [f'authlist_latency_seconds_max{{name="{_label(entry["name"])}"}} {entry["max"]}' for entry in summary['latencies']]
+        return '\n'.join(lines) + '\n'
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+metrics = RunMetrics()
+
+def instrumented(name):
+    """Decorator that records how long a phase took, for which group, and how many rows it returned."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            result = None
+            try:
+                result = function(*args, **kwargs)
+                return result
+            finally:
+                metrics.phase(name, perf_counter() - started, len(result) if isinstance(result, list) else None)
+        return wrapper
+    return decorator
+
+def write_metrics(path=None):
+    """Write the run summary atomically so a scraper never reads a half written file."""
+    path = path or metrics_file
+    if not path:
+        return
+    try:
+        content = metrics.prometheus() if path.endswith('.prom') else json.dumps(metrics.summary(), indent=2)
+        with open(f"{path}.tmp", 'w') as output:
+            output.write(content)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logging.error(f"Error writing metrics to {path}: {e}")
+
 #Base Functions
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Exponential backoff with full jitter: a random wait up to base * 2**attempt, capped."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class TokenBucket:
+    """A token bucket refilled at rate tokens per second; tokens can go negative to queue callers fairly."""
+
+    def __init__(self, rate, max_rate):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.capacity = max(1.0, max_rate)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return how long the caller has to wait before using it."""
+        with self.lock:
+            now_ = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now_ - self.updated) * self.rate)
+            self.updated = now_
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class RateLimiter:
+    """
+    Shared per-method call budgets for all API traffic in the process.
+
+    Every method (Get, Set, Add, ExecuteMultiCall, ...) has its own token bucket sized from RATE_LIMITS
+    in calls per minute. An OverLimitException halves that method's rate; each success afterwards
+    wins a little of it back, so the limiter settles just under what the server will take.
+    Time spent waiting is totalled per method for the run log.
+    """
+
+    def __init__(self, limits, default_limit):
+        self.limits = {method: float(limit) for method, limit in limits.items()}
+        self.default_limit = default_limit
+        self.buckets = {}
+        self.waited = {}
+        self.over_limit_count = {}
+        self.lock = threading.Lock()
+
+    def _bucket(self, method):
+        with self.lock:
+            if method not in self.buckets:
+                max_rate = self.limits.get(method, self.default_limit) / 60
+                self.buckets[method] = TokenBucket(max_rate, max_rate)
+            return self.buckets[method]
+
+    def _record_wait(self, method, seconds):
+        with self.lock:
+            self.waited[method] = self.waited.get(method, 0.0) + seconds
+
+    def acquire(self, method):
+        wait = self._bucket(method).reserve()
+        if wait > 0:
+            self._record_wait(method, wait)
+            sleep(wait)
+        return wait
+
+    async def acquire_async(self, method):
+        wait = self._bucket(method).reserve()
+        if wait > 0:
+            self._record_wait(method, wait)
+            await asyncio.sleep(wait)
+        return wait
+
+    def success(self, method):
+        bucket = self._bucket(method)
+        with bucket.lock:
+            if bucket.rate < bucket.max_rate:
+                bucket.rate = min(bucket.max_rate, bucket.rate + bucket.max_rate * 0.05)
+
+    def over_limit(self, method, wait):
+        bucket = self._bucket(method)
+        with bucket.lock:
+            bucket.rate = max(bucket.max_rate * 0.05, bucket.rate / 2)
+        with self.lock:
+            self.over_limit_count[method] = self.over_limit_count.get(method, 0) + 1
+        self._record_wait(method, wait)
+        logging.warning(f"{method} over the rate limit, slowing to {bucket.rate * 60:.0f}/min and waiting {wait:.1f}s")
+
+    def summary(self):
+        with self.lock:
+            parts = [f"{method}: waited {seconds:.1f}s, {self.over_limit_count.get(method, 0)} over limit" for method, seconds in sorted(self.waited.items())]
+        return "; ".join(parts) if parts else "no rate limit waits"
+
+rate_limiter = RateLimiter(rate_limits, default_rate_limit)
+
+def retry_hint(exception):
+    """Seconds the server asked us to wait, from a Retry-After header or the error data, if any; None when it is missing or malformed."""
+    response = getattr(exception, 'response', None)
+    if response is not None and response.headers.get('Retry-After'):
+        try:
+            return float(response.headers['Retry-After'])
+        except (ValueError, TypeError):
+            return None
+    data = getattr(exception, 'data', None)
+    if isinstance(data, dict):
+        for field in ('retryAfter', 'RetryAfter'):
+            if data.get(field) is not None:
+                try:
+                    return float(data[field])
+                except (ValueError, TypeError):
+                    return None
+    return None
+
+def is_over_limit(exception):
+    if isinstance(exception, MyGeotabException):
+        return exception.name == 'OverLimitException'
+    if isinstance(exception, HTTPError):
+        return exception.response is not None and exception.response.status_code == 429
+    if isinstance(exception, aiohttp.ClientResponseError):
+        return exception.status == 429
+    return False
+
+def is_call_rejected(exception):
+    """Whether the server refused a multi_call because of one of its calls, rather than the connection, a rate limit or the session."""
+    return isinstance(exception, MyGeotabException) and not is_over_limit(exception)
+
+def is_final(exception):
+    """Whether sending the same multi_call again cannot help: a call was rejected, or the client already retried or renewed."""
+    return is_call_rejected(exception) or is_over_limit(exception) or isinstance(exception, AuthenticationException)
+
+class RateLimitedAPI(API):
+    """
+    MyGeotab API client that sends every call through the shared rate limiter.
+
+    get, set, add and multi_call all go through call(), so this is the one place that waits for
+    a token and, on OverLimitException or HTTP 429, backs off (server hint first, otherwise
+    exponential with jitter) and tries again. When the session has expired it is renewed once
+    with renew_session and the call retried.
+    """
+
+    def call(self, method, **parameters):
+        renewed = False
+        for attempt in range(api_retries):
+            rate_limiter.acquire(method)
+            started = perf_counter()
+            try:
+                result = super().call(method, **parameters)
+                rate_limiter.success(method)
+                return result
+            except AuthenticationException:
+                # The session expired; API objects built from saved credentials cannot log in again on their own
+                if renewed or attempt == api_retries - 1:
+                    raise
+                self.credentials = renew_session(self.credentials)
+                renewed = True
+            except (MyGeotabException, HTTPError) as e:
+                if not is_over_limit(e) or attempt == api_retries - 1:
+                    raise
+                wait = retry_hint(e) or backoff_delay(attempt)
+                rate_limiter.over_limit(method, wait)
+                metrics.retry('over_limit')
+                sleep(wait)
+            finally:
+                metrics.api_call(method, parameters.get('type_name'), perf_counter() - started)
+                for call in parameters.get('calls', []) if method == 'ExecuteMultiCall' else []:
+                    metrics.api_call(f"{method}/{call['method']}", call.get('params', {}).get('typeName'), 0.0)
+
+    @staticmethod
+    def from_credentials(credentials):
+        return RateLimitedAPI(
+            username=credentials.username,
+            password=credentials.password,
+            database=credentials.database,
+            session_id=credentials.session_id,
+            server=credentials.server,
+        )
+
+class AsyncRateLimitedAPI(api_async.API):
+    """
+    The asyncio MyGeotab client, with the same rate limiting, backoff and session renewal as RateLimitedAPI.
+
+    Waits are spent in asyncio.sleep, so a coroutine waiting for a token or backing off does not hold
+    up the others in flight. Logging in again is a blocking call and runs in a worker thread.
+    """
+
+    async def call_async(self, method, **parameters):
+        renewed = False
+        for attempt in range(api_retries):
+            await rate_limiter.acquire_async(method)
+            started = perf_counter()
+            try:
+                result = await super().call_async(method, **parameters)
+                rate_limiter.success(method)
+                return result
+            except AuthenticationException:
+                if renewed or attempt == api_retries - 1:
+                    raise
+                self.credentials = await asyncio.to_thread(renew_session, self.credentials)
+                renewed = True
+            except (MyGeotabException, aiohttp.ClientResponseError) as e:
+                if not is_over_limit(e) or attempt == api_retries - 1:
+                    raise
+                wait = retry_hint(e) or backoff_delay(attempt)
+                rate_limiter.over_limit(method, wait)
+                metrics.retry('over_limit')
+                await asyncio.sleep(wait)
+            finally:
+                metrics.api_call(method, parameters.get('type_name'), perf_counter() - started)
+                for call in parameters.get('calls', []) if method == 'ExecuteMultiCall' else []:
+                    metrics.api_call(f"{method}/{call['method']}", call.get('params', {}).get('typeName'), 0.0)
+
+    @staticmethod
+    def from_credentials(credentials):
+        return AsyncRateLimitedAPI(
+            username=credentials.username,
+            password=credentials.password,
+            database=credentials.database,
+            session_id=credentials.session_id,
+            server=credentials.server,
+        )
+
+# The session every API object is built from; replaced by renew_session when MyGeotab expires it
+session_credentials = None
+session_lock = threading.Lock()
+
+def renew_session(stale_credentials):
+    """
+    Log in again after the server rejected a session, once for every thread that hit it.
+
+    Parameters:
+    stale_credentials (Credentials): The credentials of the rejected call.
+
+    Returns:
+    Credentials: The new session, or the one another thread already renewed.
+
+    Raises:
+    AuthenticationException: If the username and password are no longer accepted.
+    """
+    global session_credentials
+    with session_lock:
+        if session_credentials is not None and session_credentials.session_id != stale_credentials.session_id:
+            return session_credentials
+        session_credentials = API(username, password, database, server=stale_credentials.server).authenticate()
+        metrics.retry('session_renewed')
+        logging.info("MyGeotab session expired, authenticated again.")
+        return session_credentials
+
+@instrumented('authenticate')
 def authenticate(db_file):
     """This is to authenticate and then grab the session token so all further calls need not reauthenticate; we also establish our sqlite connection"""
+    global session_credentials
     try:
         api = API(username, password, database)
         credentials = api.authenticate()
+        session_credentials = credentials
         conn = create_connection(db_file)
+        create_status_table(conn)
+        migrate_wide_key_tables(conn)
+        create_feed_tables(conn)
         logging.info("Authenticated successfully.")
-        new_api = API.from_credentials(credentials)
+        new_api = RateLimitedAPI.from_credentials(credentials)
         return new_api, conn, credentials
     except Exception as e:
         logging.error(f"Authentication failed: {e}")
@@ -50,68 +508,493 @@ def authenticate(db_file):
 
 
 ###Database Functions (for memory in between runs) ##################################################################################################################################################
-# We will be storing all keys in a table labeled keys_group id for comparison later, we need to keep a list of who we've added so we know what to remove in the future. There is a 1000 key limit on the iox device and we cannot retrieve this from the device itself. 
+# We will be storing all keys in a table labeled keys_group id for comparison later, and whether each key has reached each device in key_device_status, we need to keep a list of who we've added so we know what to remove in the future. There is a 1000 key limit on the iox device and we cannot retrieve this from the device itself. 
 # It also wouldn't make sense to enable this feature and not do this.
 # Function to create SQLite connection
 
 def create_connection(db_file):
     try:
-        conn = sqlite3.connect(db_file)
+        # Every group worker has its own connection; wait on the write lock instead of failing
+        conn = sqlite3.connect(db_file, timeout=30)
+        # WAL lets the workers read while another connection writes; NORMAL sync is still safe against a
+        # crash of the script, only an OS crash or power loss can roll back the last commits
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")
         return conn
     except sqlite3.Error as e:
         logging.error(f"Error connecting to SQLite database: {e}")
     return None
 
 def create_table(conn, table_name, table_schema, unique):
+    try:
+        # No commit here: inside a group's journal transaction the table is created as part of it
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                {table_schema},
+                UNIQUE({unique})
+
+            );
+        ''')
+    except sqlite3.Error as e:
+        logging.error(f"Error creating table {table_name}: {e}")
+
+def stage(conn, table_name, table_schema, rows):
+    """
+    Load rows into a temporary table, replacing what it held, so a helper can diff against it in one statement.
+
+    Temporary tables belong to the connection, so group workers never see each other's staging.
+    This replaces NOT IN lists with one placeholder per item, which ran into SQLite's variable limit
+    on large groups. Duplicate rows are dropped when the schema has a key.
+
+    Parameters:
+    conn (object): The database connection object.
+    table_name (str): The name of the temporary table.
+    table_schema (str): Its column definitions.
+    rows (list): The rows to stage, as tuples in column order.
+
+    Returns:
+    None
+    """
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table_name} ({table_schema})")
+    conn.execute(f"DELETE FROM temp.{table_name}")
+    columns = conn.execute(f"SELECT * FROM temp.{table_name} LIMIT 0").description
+    conn.executemany(f"INSERT OR IGNORE INTO temp.{table_name} VALUES ({','.join('?' for _ in columns)})", rows)
+
+def create_status_table(conn):
+    """
+    Create the key/vehicle status table and its indexes.
+
+    One row per (device, key) records the state of that key on that vehicle: queued or failed (unsent),
+    sent and waiting (pending) or confirmed delivered. A vehicle's rows are its last known authorization
+    list, whatever groups the keys came from. Older databases had a row per (group, device, key); those
+    are folded into one row per vehicle and key, keeping the most advanced state.
+    This replaces the old layout where every device was a column in `keys_{group_id}`, which
+    ran into SQLite's column limit and needed a full table rebuild to drop a device.
+
+    The driver_keys table keeps the last seen key object for every serial number, so a key that is no
+    longer in any group can still be removed from a vehicle.
+
+    Parameters:
+    conn (object): The database connection object.
+
+    Returns:
+    None
+
+    Raises:
+    sqlite3.Error: Logs any SQLite errors encountered during the process.
+    """
     try:
         with conn:
-            conn.execute(f'''
-                CREATE TABLE IF NOT EXISTS {table_name} (
-                    {table_schema},
-                    UNIQUE({unique})
+            columns = [info[1] for info in conn.execute("PRAGMA table_info(key_device_status)").fetchall()]
+            if 'group_id' in columns:
+                conn.execute("ALTER TABLE key_device_status RENAME TO key_device_status_by_group")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS key_device_status (
+                    device_id TEXT NOT NULL,
+                    serial_number TEXT NOT NULL,
+                    state INTEGER NOT NULL DEFAULT 0,
+                    updated_at TEXT,
+                    message_id TEXT,
+                    PRIMARY KEY (device_id, serial_number)
+                );
+            ''')
+            if 'group_id' in columns:
+                message_column = 'message_id' if 'message_id' in columns else 'NULL'
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO key_device_status (device_id, serial_number, state, updated_at, message_id)
+                    SELECT device_id, serial_number, state, updated_at, {message_column} FROM key_device_status_by_group
+                    ORDER BY state DESC
+                ''')
+                conn.execute("DROP TABLE key_device_status_by_group")
+                logging.info("Migrated key_device_status to one row per vehicle and key")
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_key_device_status_state
+                ON key_device_status (state, device_id)
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_key_device_status_message
+                ON key_device_status (message_id)
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS driver_keys (
+                    serial_number TEXT PRIMARY KEY,
+                    driver_key TEXT NOT NULL
+                );
+            ''')
+    except sqlite3.Error as e:
+        logging.error(f"Error creating key_device_status table: {e}")
+
+def migrate_wide_key_tables(conn):
+    """
+    Convert keys_{group_id} tables from the old one-column-per-device layout.
+
+    Every column other than the key fields is a device id; its values are copied into 
+    `key_device_status` and the keys table is rebuilt with only the key fields. Tables that 
+    are already narrow are left alone, so this is safe to run on every start.
 
+    Parameters:
+    conn (object): The database connection object.
+
+    Returns:
+    None
+
+    Raises:
+    sqlite3.Error: Logs any SQLite errors encountered during the process.
+    """
+    key_columns = ['driverKeyType', 'id', 'keyId', 'serialNumber']
+    try:
+        cursor = conn.cursor()
+        cursor.execute(r"SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'keys\_%' ESCAPE '\'")
+        tables = [row[0] for row in cursor.fetchall() if not row[0].endswith('_new')]
+        for table in tables:
+            cursor.execute(f"PRAGMA table_info({table})")
+            device_columns = [info[1] for info in cursor.fetchall() if info[1] not in key_columns]
+            if not device_columns:
+                continue
+            migrated_at = datetime.now(timezone.utc).isoformat()
+            with conn:
+                for device_id in device_columns:
+                    conn.execute(f'''
+                        INSERT INTO key_device_status (device_id, serial_number, state, updated_at)
+                        SELECT ?, serialNumber, COALESCE("{device_id}", 0), ? FROM {table} WHERE true
+                        ON CONFLICT (device_id, serial_number) DO UPDATE SET state = MAX(state, excluded.state)
+                    ''', (device_id, migrated_at))
+                conn.execute(f"DROP TABLE IF EXISTS {table}_new")
+                conn.execute(f'''
+                    CREATE TABLE {table}_new (
+                        driverKeyType TEXT, id TEXT, keyId TEXT, serialNumber TEXT PRIMARY KEY,
+                        UNIQUE(serialNumber)
+                    )
+                ''')
+                conn.execute(f'''
+                    INSERT INTO {table}_new (driverKeyType, id, keyId, serialNumber)
+                    SELECT driverKeyType, id, keyId, serialNumber FROM {table}
+                ''')
+                conn.execute(f"DROP TABLE {table}")
+                conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+            logging.info(f"Migrated {len(device_columns)} device columns from {table} to key_device_status")
+    except sqlite3.Error as e:
+        logging.error(f"Error migrating wide key tables: {e}")
+
+###Feed cache (incremental sync) ##################################################################################################################################################
+# With INCREMENTAL_SYNC on, Users and Devices are pulled with GetFeed and kept in authlist.db. Only entities changed since the stored
+# toVersion are downloaded; each group's users and devices are then read from the local copy instead of being re-downloaded every run.
+feed_group_fields = {'User': 'companyGroups', 'Device': 'groups'}
+# The only User and Device properties any stage reads; everything else (rules, custom properties, ...) is left on the
+# server. Entities that need a Set are fetched again in full by patch_entities, since a Set replaces the whole entity.
+entity_properties = {
+    'User': ['id', 'isDriver', 'keys', 'companyGroups', 'activeTo', 'timezoneid', 'securityGroups'],
+    'Device': ['id', 'serialNumber', 'groups', 'activeTo', 'customParameters', 'timeZoneId'],
+}
+
+def property_selector(type_name):
+    # Passed to api.call rather than api.get, which would fold it into the search
+    return {'fields': entity_properties[type_name], 'isIncluded': True}
+
+def create_feed_tables(conn):
+    """
+    Create the tables that hold the GetFeed versions and the cached User and Device entities.
+
+    Parameters:
+    conn (object): The database connection object.
+
+    Returns:
+    None
+
+    Raises:
+    sqlite3.Error: Logs any SQLite errors encountered during the process.
+    """
+    try:
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS feed_versions (
+                    type_name TEXT PRIMARY KEY,
+                    to_version TEXT,
+                    updated_at TEXT
                 );
             ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS feed_entities (
+                    type_name TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    active_to TEXT,
+                    entity TEXT NOT NULL,
+                    PRIMARY KEY (type_name, id)
+                );
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS feed_entity_groups (
+                    type_name TEXT NOT NULL,
+                    group_id TEXT NOT NULL,
+                    entity_id TEXT NOT NULL,
+                    PRIMARY KEY (type_name, group_id, entity_id)
+                );
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_feed_entity_groups_entity
+                ON feed_entity_groups (type_name, entity_id)
+            ''')
     except sqlite3.Error as e:
-        logging.error(f"Error creating table {table_name}: {e}")
+        logging.error(f"Error creating feed tables: {e}")
+
+def get_feed_version(conn, type_name):
+    cursor = conn.execute("SELECT to_version FROM feed_versions WHERE type_name = ?", (type_name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
 
+def format_active_to(value):
+    """Normalise an activeTo value to a UTC ISO string so it can be compared in SQL."""
+    if hasattr(value, 'astimezone'):
+        return value.astimezone(timezone.utc).isoformat()
+    return value
 
-def get_users_with_nfc_keys(api, group_id, group_name, conn, exception_keys):
+def apply_feed(conn, type_name, entities, to_version):
     """
-    Fetch and manage users with NFC keys for a specific group.
+    Store one page of GetFeed results and the version it brings the cache up to, in one transaction.
 
-    This function creates a database table for the given group if it doesn't already exist. 
-    It then fetches active users who are drivers (have keys assigned to them) from the API and 
-    processes their NFC keys. 
-    It then checks the database and adds missing keys and removes keys not returned by the api
+    Parameters:
+    conn (object): The database connection object.
+    type_name (str): 'User' or 'Device'.
+    entities (list): The changed entities returned by GetFeed.
+    to_version (str): The toVersion returned with the page.
+
+    Returns:
+    None
+    """
+    group_field = feed_group_fields[type_name]
+    with conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO feed_entities (type_name, id, active_to, entity) VALUES (?, ?, ?, ?)
+        ''', [(type_name, entity['id'], format_active_to(entity.get('activeTo')), json_serialize(entity)) for entity in entities])
+        conn.executemany('''
+            DELETE FROM feed_entity_groups WHERE type_name = ? AND entity_id = ?
+        ''', [(type_name, entity['id']) for entity in entities])
+        conn.executemany('''
+            INSERT OR IGNORE INTO feed_entity_groups (type_name, group_id, entity_id) VALUES (?, ?, ?)
+        ''', [(type_name, group['id'], entity['id']) for entity in entities for group in entity.get(group_field, [])])
+        conn.execute('''
+            INSERT OR REPLACE INTO feed_versions (type_name, to_version, updated_at) VALUES (?, ?, ?)
+        ''', (type_name, to_version, datetime.now(timezone.utc).isoformat()))
+
+@instrumented('sync_feed')
+def sync_feed(api, conn, type_name, full=False):
+    """
+    Bring the local copy of a type up to date with GetFeed.
+
+    Pages through GetFeed from the stored toVersion until a short page comes back. With full=True
+    (or when no version is stored yet) the cached entities are dropped and the whole type is reloaded.
+
+    Parameters:
+    api (object): The API object used to call GetFeed.
+    conn (object): The database connection object.
+    type_name (str): 'User' or 'Device'.
+    full (bool): Throw away the cache and version and resync everything. Default is False.
+
+    Returns:
+    int: The number of changed entities applied.
+
+    Raises:
+    Exception: Logs and re-raises any error, leaving the stored version at the last applied page.
+    """
+    try:
+        version = None if full else get_feed_version(conn, type_name)
+        if version is None:
+            with conn:
+                conn.execute("DELETE FROM feed_entities WHERE type_name = ?", (type_name,))
+                conn.execute("DELETE FROM feed_entity_groups WHERE type_name = ?", (type_name,))
+                conn.execute("DELETE FROM feed_versions WHERE type_name = ?", (type_name,))
+        changed = 0
+        while True:
+            result = api.call('GetFeed', type_name=type_name, from_version=version, results_limit=feed_results_limit,
+                              property_selector=property_selector(type_name))
+            entities = result.get('data', [])
+            version = result.get('toVersion')
+            apply_feed(conn, type_name, entities, version)
+            changed += len(entities)
+            if len(entities) < feed_results_limit:
+                break
+        logging.info(f"{type_name} feed synced to version {version}: {changed} changed")
+        return changed
+    except Exception as e:
+        logging.error(f"Error syncing {type_name} feed: {e}")
+        raise
+
+def load_group_tree(groups):
+    """Record the child groups of every group so membership can be resolved locally like the server does."""
+    group_tree.clear()
+    for group in groups:
+        group_tree[group['id']] = [child['id'] for child in group.get('children', [])]
+
+def group_descendants(group_id):
+    """Return the group id and the ids of every group below it."""
+    found = {group_id}
+    stack = [group_id]
+    while stack:
+        for child_id in group_tree.get(stack.pop(), []):
+            if child_id not in found:
+                found.add(child_id)
+                stack.append(child_id)
+    return found
+
+def cached_entities(conn, type_name, group_id):
+    """
+    Read the active entities of a type in a group, including its child groups, from the feed cache.
+
+    Parameters:
+    conn (object): The database connection object.
+    type_name (str): 'User' or 'Device'.
+    group_id (str): The ID of the group.
+
+    Returns:
+    generator: The cached entities, deserialized the same way the API returns them, one at a time.
+    """
+    group_ids = list(group_descendants(group_id))
+    placeholders = ','.join('?' for _ in group_ids)
+    cursor = conn.execute(f'''
+        SELECT e.entity FROM feed_entities e
+        WHERE e.type_name = ? AND (e.active_to IS NULL OR e.active_to >= ?)
+        AND e.id IN (SELECT entity_id FROM feed_entity_groups WHERE type_name = ? AND group_id IN ({placeholders}))
+    ''', [type_name, datetime.now(timezone.utc).isoformat(), type_name] + group_ids)
+    for row in cursor:
+        yield json_deserialize(row[0])
+
+class FleetSnapshot:
+    """
+    Every active driver and device, downloaded once at the start of a run and indexed by group.
+
+    Without it each group costs its own server-side filtered User and Device calls, and users and
+    vehicles in several groups are downloaded several times. Group membership is resolved through
+    group_tree so a group's slice includes its child groups, matching the server-side search.
+    Slices are deep copies because the group workers patch the entities they are given.
+    """
+
+    def __init__(self, users, devices):
+        self._index = {
+            'User': self._by_group(users, feed_group_fields['User']),
+            'Device': self._by_group(devices, feed_group_fields['Device']),
+        }
+        logging.info(f"Fleet snapshot: {len(users)} drivers, {len(devices)} devices")
+
+    @staticmethod
+    def _by_group(entities, group_field):
+        index = {}
+        for entity in entities:
+            for group in entity.get(group_field, []):
+                index.setdefault(group['id'], []).append(entity)
+        return index
+
+    @classmethod
+    @instrumented('fleet_snapshot')
+    def fetch(cls, api):
+        now_utc = datetime.now(timezone.utc)
+        users = list(iterate_entities(api, 'User', {"fromDate": now_utc, "isDriver": True}))
+        devices = list(iterate_entities(api, 'Device', {"fromDate": now_utc}))
+        return cls(users, devices)
+
+    def entities(self, type_name, group_id):
+        index = self._index[type_name]
+        found = {}
+        for member_group in group_descendants(group_id):
+            for entity in index.get(member_group, []):
+                found.setdefault(entity['id'], entity)
+        return copy.deepcopy(list(found.values()))
+
+def iterate_entities(api, type_name, search):
+    """
+    Yield the entities matching a search page by page instead of downloading the whole result set at once.
+
+    Pages of ENTITY_PAGE_SIZE are read in id order, each starting after the last id of the one before.
+    The next page is requested as soon as a page arrives, so it downloads while the caller works
+    through the current one, and only two pages are held at a time.
+
+    Parameters:
+    api (object): The API object used to call Get.
+    type_name (str): 'User' or 'Device'.
+    search (dict): The search to page through.
+
+    Returns:
+    generator: The matching entities, with only the properties in entity_properties.
+    """
+    group_name = getattr(metrics.local, 'group', None)
+
+    def get_page(offset):
+        # The prefetch thread records its calls against the same group as the caller
+        metrics.group(group_name)
+        sort = {'sortBy': 'id', 'sortDirection': 'asc'}
+        if offset is not None:
+            sort.update(offset=offset, lastId=offset)
+        return api.call('Get', type_name=type_name, search=search, results_limit=entity_page_size, sort=sort,
+                        property_selector=property_selector(type_name))
+
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        page = get_page(None)
+        while page:
+            next_page = prefetch.submit(get_page, page[-1]['id']) if len(page) >= entity_page_size else None
+            yield from page
+            page = next_page.result() if next_page else []
+
+def fetch_users(api, conn, group_id, drivers_only=True):
+    """Active users in a group, from the feed cache or fleet snapshot when enabled, otherwise paged from the API."""
+    if incremental_sync:
+        users = cached_entities(conn, 'User', group_id)
+        return (user for user in users if user.get('isDriver')) if drivers_only else users
+    # The snapshot only holds drivers; the exception group is still fetched on its own
+    if fleet_snapshot and drivers_only:
+        return fleet_snapshot.entities('User', group_id)
+    now_utc = datetime.now(timezone.utc)
+    search = {'companyGroups': [{'id': group_id}], "fromDate": now_utc}
+    if drivers_only:
+        search['isDriver'] = True
+    return iterate_entities(api, 'User', search)
+
+def fetch_devices(api, conn, group_id):
+    """Active devices in a group, from the feed cache or fleet snapshot when enabled, otherwise paged from the API."""
+    if incremental_sync:
+        return cached_entities(conn, 'Device', group_id)
+    if fleet_snapshot:
+        return fleet_snapshot.entities('Device', group_id)
+    now_utc = datetime.now(timezone.utc)
+    return iterate_entities(api, 'Device', {'groups': [{'id': group_id}], "fromDate": now_utc})
+
+
+@instrumented('get_users_with_nfc_keys')
+def get_users_with_nfc_keys(api, group_id, group_name, conn, batcher=None):
+    """
+    Fetch the NFC keys of the users in a specific group.
+
+    This function fetches active users who are drivers (have keys assigned to them) from the API and
+    processes their NFC keys, applying the user patches on the way. Users are consumed as they are paged
+    in and only their key fields and ids are kept (plus, with PATCH_USERS, the users new to the group).
+    Comparing the keys with those stored for the group is left to plan_vehicles, which does it for every
+    group in one transaction.
 
     Parameters:
     api (object): The API object used to fetch users and their keys.
     group_id (str): The ID of the group for which to fetch users and keys.
     group_name (str): The name of the group for logging and display purposes.
     conn (object): The database connection object.
-    exception_keys (list): A list of exception keys to be considered during processing.
+    batcher (MultiCallBatcher): Optional shared send queue for the batched user Set calls.
 
     Returns:
-    Lists: A list of dictionaries containing the users key object
-        - new_keys (list): List of new keys inserted into the database.
-        - remove_keys (list): List of keys removed from the database.
-        - all_keys (list): List of all keys returned from the api.
+    list: All of the group's keys as returned from the api. Exception keys are kept apart, see plan_vehicles.
 
     Raises:
-    Exception: Logs and returns empty lists in case of any errors during the process.
+    Exception: Logs and re-raises any error; an empty list would read as every key having been removed.
     """
-    
+
     try:
-        # Create table if not exists for the group_id
-        create_table(conn, f"keys_{group_id}", "driverKeyType TEXT, id TEXT, keyId TEXT, serialNumber TEXT PRIMARY KEY", "serialNumber")
         #We only want active Drivers 
-        now_utc = datetime.now(timezone.utc)
-        users = api.get('User', search={'companyGroups': [{'id': group_id}], "fromDate": now_utc ,"isDriver": True })
+        users = fetch_users(api, conn, group_id)
    
         """Fetch users and their keys - we only want users in the group of the loop (group id), we only want active users, (dateFrom); Is driver, we only need to return users that can or do have keys"""
         all_userids = []
         nfc_keys = []
+        new_users = []
+        if patch_users:
+            create_table(conn, f"users_{group_id}", "userid TEXT PRIMARY KEY","userid")
+            stored_users = {row[0] for row in conn.execute(f"SELECT userid FROM users_{group_id}")}
         for user in users:
             if 'keys' in user:
                 for key in user['keys']:
@@ -123,28 +1006,30 @@ def get_users_with_nfc_keys(api, group_id, group_name, conn, exception_keys):
                     }
                     nfc_keys.append(key_data)
             all_userids.append(user['id'])
+            # Only users new to the group get patched, so those are the only whole users kept
+            if patch_users and user['id'] not in stored_users:
+                new_users.append(user)
 
         # Get new keys inserted and removed from the database
         if patch_users:
-            modify_users(api, users, conn, all_userids, group_id, group_name)
-        all_keys = nfc_keys + [key for key in exception_keys if key['serialNumber'] not in {k['serialNumber'] for k in nfc_keys}]
-        new_keys = insert_keys(conn, group_id, all_keys)
-        remove_keys = remove_unused_keys(conn, group_id, all_keys)
-        return new_keys, remove_keys, all_keys
+            modify_users(api, new_users, conn, all_userids, group_id, group_name, batcher)
+        return nfc_keys
     except Exception as e:
         logging.error(f"Error fetching users with NFC keys for group {group_id}: {e}")
-        return [],[],[]
+        raise
 
-def get_exception_users(api , exception_group):
+@instrumented('get_exception_users')
+def get_exception_users(api , exception_group, conn=None):
     """
     Fetch users with NFC keys for a specified exception group.
 
-    This function retrieves users from the specified exception group and extracts their NFC keys. 
-    It returns a list of key data that is combined with every other groups key table.
+    This function retrieves users from the specified exception group and extracts their NFC keys.
+    They are stored once, in keys_exceptions, and given to every synced vehicle by plan_vehicles.
 
     Parameters:
     api (object): The API object used to fetch users and their keys.
     exception_group (str): The ID of the exception group for which to fetch users and keys.
+    conn (object): The database connection object, used to read the feed cache in incremental mode.
 
     Returns:
     list: A list of dictionaries containing key data for each user in the exception group. 
@@ -155,12 +1040,12 @@ def get_exception_users(api , exception_group):
           - serialNumber (str): The serial number of the key.
 
     Raises:
-    Exception: Logs and returns an empty list in case of any errors during the process.
+    Exception: Logs and returns None in case of any errors during the process, so the stored exception
+    keys are kept rather than removed from every vehicle.
     """
     try:
         exception_keys = []
-        now_utc = datetime.now(timezone.utc)
-        users = api.get('User', search={'companyGroups': [{'id': exception_group}], "fromDate": now_utc})
+        users = fetch_users(api, conn, exception_group, drivers_only=False)
         for user in users:
             if 'keys' in user:
                 for key in user['keys']:
@@ -175,43 +1060,45 @@ def get_exception_users(api , exception_group):
         return exception_keys
     except Exception as e:
         logging.error(f"Error fetching users with NFC keys for exception group: {e}")
-        return []
+        return None
 
 ### Insert new keys into database
+# The key and device table changes below are not committed here; plan_vehicles commits them in one transaction
+# with the operations planned from them, so a crash can never keep the one and lose the other.
+@instrumented('insert_keys')
 def insert_keys(conn, group_id, keys):
     new_keys = []
     try:
-        with conn:
-            c = conn.cursor()
-            for key in keys:
-                c.execute(f'''
-                    INSERT OR IGNORE INTO keys_{group_id} (driverKeyType, id, keyId, serialNumber) 
-                    VALUES (?, ?, ?, ?)
-                ''', (key['driverKeyType'], key['id'], key['keyId'], key['serialNumber']))
-                if c.rowcount > 0:
-                    new_keys.append(key)
+        stage(conn, 'staged_keys', "driverKeyType TEXT, id TEXT, keyId TEXT, serialNumber TEXT",
+              [(key['driverKeyType'], key['id'], key['keyId'], key['serialNumber']) for key in keys])
+        # Only rows that were actually inserted come back, i.e. the new keys
+        inserted = conn.execute(f'''
+            INSERT OR IGNORE INTO keys_{group_id} (driverKeyType, id, keyId, serialNumber)
+            SELECT driverKeyType, id, keyId, serialNumber FROM temp.staged_keys ORDER BY rowid
+            RETURNING driverKeyType, id, keyId, serialNumber
+        ''').fetchall()
+        new_keys = [{'driverKeyType': key[0], 'id': key[1], 'keyId': key[2], 'serialNumber': key[3]} for key in inserted]
         logging.info(f"Keys inserted for group {group_id}: {new_keys}")
         return new_keys
     except sqlite3.Error as e:
         logging.error(f"Error inserting keys for group {group_id}: {e}")
-        return []
+        raise
 
 
 #Remove unused keys from storage
 
 
+@instrumented('remove_unused_keys')
 def remove_unused_keys(conn, group_id, keys):
     removed_keys_list = []
     try:
-        c = conn.cursor()
-        placeholders = ','.join('?' for _ in keys)
-        query = f'''
-            DELETE FROM keys_{group_id} WHERE serialNumber NOT IN ({placeholders})
+        stage(conn, 'staged_serials', "serialNumber TEXT PRIMARY KEY", [(key['serialNumber'],) for key in keys])
+        removed_keys = conn.execute(f'''
+            DELETE FROM keys_{group_id} WHERE NOT EXISTS (
+                SELECT 1 FROM temp.staged_serials s WHERE s.serialNumber = keys_{group_id}.serialNumber
+            )
             RETURNING driverKeyType, id, keyId, serialNumber
-        '''
-        c.execute(query, [key['serialNumber'] for key in keys])
-        removed_keys = c.fetchall()
-        conn.commit()
+        ''').fetchall()
         
         if removed_keys:
             removed_keys_list = [{'driverKeyType': key[0], 'id': key[1], 'keyId': key[2], 'serialNumber': key[3]} for key in removed_keys]
@@ -220,12 +1107,13 @@ def remove_unused_keys(conn, group_id, keys):
         return removed_keys_list
     except sqlite3.Error as e:
         logging.error(f"Error removing unused keys for group {group_id}: {e}")
-        return removed_keys_list
+        raise
 # I stored users seperate from keys to prevent un needed checks or issues; if we use user id's as the primary key then key updates would not work, 
 # the other way around would make unnecessary set calls or checks that might end up overriding intended exceptions. 
 # The other thing to prevent is if a user were in two groups that had different intended TZ's they would get two change calls everytime this ran
 # This way users will only be processed once they join a group and that's it.
-def modify_users(api, users, conn, all_userid, group_id, group_name):
+@instrumented('modify_users')
+def modify_users(api, users, conn, all_userid, group_id, group_name, batcher=None):
     """
     This function manages user data by:
     - Creating a database table for the users of the specified group if not existing.
@@ -236,79 +1124,82 @@ def modify_users(api, users, conn, all_userid, group_id, group_name):
 
     Parameters:
     api (object): The API object used to fetch and update user data.
-    users (list): A list of user dictionaries to be processed.
+    users (list): The user dictionaries to be processed; only those new to the group are patched.
     conn (object): The database connection object.
     all_userid (list): A list of user IDs that are part of the group.
     group_id (str): The ID of the group being processed.
     group_name (str): The name of the group being processed.
+    batcher (MultiCallBatcher): Optional shared send queue; the user updates are sent as batched Set calls.
 
     Returns:
     None
 
     Raises:
-    KeyError: If there is a missing key in the user dictionary.
-    Exception: Logs any other exceptions encountered during the process.
+    KeyError: Logs and counts a missing key in the user dictionary.
+    Exception: Logs and counts any other exceptions encountered during the process.
     """
     try:
         create_table(conn, f"users_{group_id}", "userid TEXT PRIMARY KEY","userid")
-        remove_unused_users(conn, group_id, all_userid)
-        new_users = insert_users(conn, group_id, all_userid)
+        # One transaction for the group's user table
+        with conn:
+            remove_unused_users(conn, group_id, all_userid)
+            new_users = insert_users(conn, group_id, all_userid)
         if new_users:
-            group_tz = os.getenv(f"{group_name}", 'America/Vancouver')            
+            group_tz = group_timezones.get(group_name, 'America/Vancouver')
 
+            def patch(user):
+                updated = False
+                if user.get('timezoneid') != group_tz and patch_tz:
+                    user['timezoneid'] = group_tz
+                    updated = True
 
-            for user in users:
-                if user['id'] in new_users:
-                    updated = False
-                    if user.get('timezoneid') != group_tz and patch_tz:
-                        user['timezoneid'] = group_tz
-                        updated = True
 
+                if patch_sc and any(sc['id'] in old_scid for sc in user['securityGroups']):
+                    for sc in user['securityGroups']:
+                        if sc['id'] in old_scid:
+                            sc['id'] = new_scid
+                            updated = True
+                return updated
 
-                    if patch_sc and any(sc['id'] in old_scid for sc in user['securityGroups']):
-                        for sc in user['securityGroups']:
-                            if sc['id'] in old_scid:
-                                sc['id'] = new_scid
-                                updated = True
-                    if updated:
-                        api.set('User', user)
+            updated_users = [user for user in users if user['id'] in new_users and patch(user)]
+            patch_entities(api, 'User', updated_users, patch, batcher)
 
     
     except KeyError as e:
-        print(f"Key error: {e}")
+        metrics.error()
+        logging.error(f"Key error while updating users in group {group_name}: {e}")
     except Exception as e:
-        print(f"An error occurred: {e}")
+        metrics.error()
+        logging.error(f"Error updating users in group {group_name}: {e}")
 
 
+@instrumented('insert_users')
 def insert_users(conn, group_id, all_userids):
     new_usersid = []
     try:
-        with conn:
-            c = conn.cursor()
-            for userid in all_userids:
-                c.execute(f'''
-                    INSERT OR IGNORE INTO users_{group_id} (userid) 
-                    VALUES (?)
-                ''', (userid,))
-                if c.rowcount > 0:
-                    new_usersid.append(userid)
+        stage(conn, 'staged_ids', "id TEXT PRIMARY KEY", [(userid,) for userid in all_userids])
+        inserted = conn.execute(f'''
+            INSERT OR IGNORE INTO users_{group_id} (userid)
+            SELECT id FROM temp.staged_ids
+            RETURNING userid
+        ''').fetchall()
+        new_usersid = [row[0] for row in inserted]
         logging.info(f"New users stored for group {group_id}: {new_usersid}")
         return new_usersid
     except sqlite3.Error as e:
         logging.error(f"Error inserting users for group {group_id}: {e}")
         return []
 
+@instrumented('remove_unused_users')
 def remove_unused_users(conn, group_id, all_userids):
     try:
-        c = conn.cursor()
-        placeholders = ','.join('?' for _ in all_userids)
-        query = f'''
-            DELETE FROM users_{group_id} WHERE userid NOT IN ({placeholders})
+        stage(conn, 'staged_ids', "id TEXT PRIMARY KEY", [(userid,) for userid in all_userids])
+        removed_users = conn.execute(f'''
+            DELETE FROM users_{group_id} WHERE NOT EXISTS (
+                SELECT 1 FROM temp.staged_ids s WHERE s.id = users_{group_id}.userid
+            )
             RETURNING userid
-        '''
-        c.execute(query, all_userids)
-        removed_users = c.fetchall()
-        conn.commit()
+        ''').fetchall()
         
         if removed_users:
             logging.info(f"Users removed for group {group_id}")
@@ -319,186 +1210,512 @@ def remove_unused_users(conn, group_id, all_userids):
 ##Vehicle Database portion
 ##
 ##
-def get_vans_by_group(api, group_id, group_name, conn,add=False):
+@instrumented('load_group_devices')
+def load_group_devices(api, group_id, group_name, conn, enable_authlist=True, batcher=None):
     """
-    Fetch and manage devices (vans) by group.
+    Fetch a group's devices and apply the device patches.
 
-    This function creates a database table for the given group if it doesn't already exist. 
-    It fetches devices from the API, optionally adds a custom parameter to enable the authorized driver list, 
-    and updates the devices if necessary. It also handles inserting new devices and removing old ones from the database.
+    Adds the "Enable Authorised Driver List" custom parameter when enable_authlist is set and,
+    with PATCH_ASSETS and PATCH_TZ, sets the group's timezone.
 
     Parameters:
     api (object): The API object used to fetch and update devices.
     group_id (str): The ID of the group for which to fetch devices.
     group_name (str): The name of the group to get the environment variable timezone.
     conn (object): The database connection object.
-    add (bool): A flag indicating whether to split this function for the two times it runs; 
-    also stops processing device changes during the remove phase
+    enable_authlist (bool): Whether to add the authorized driver list custom parameter. Default is True.
+    batcher (MultiCallBatcher): Optional shared send queue for the batched device Set calls.
 
     Returns:
-    tuple: A tuple containing:
-        - filtered_devices (list): List of devices after processing.
-        - new_devices (list, during second round): List of new devices inserted into the database if 'add' is True.
-        - removed_devices (list, during first round): List of devices removed from the database if 'add' is False.
-
-    Raises:
-    MyGeotabException: Custom exception with error details if any issues occur during the process.
+    list: A list of dictionaries with the 'id' and 'serialNumber' of every device.
     """
+    logging.info(f"Fetching devices for group ID: {group_id}")
+    # Paged: each device is reduced to its id and serial number as it arrives
+    devices = fetch_devices(api, conn, group_id)
+    group_tz = group_timezones.get(group_name, 'America/Vancouver')
+
+    def patch(device):
+        updated = False
+        custom_parameters = device.setdefault('customParameters', [])
+        if enable_authlist and not any(param.get('description') == "Enable Authorised Driver List" for param in custom_parameters):
+            new_param = {
+                "bytes": "CA==",
+                "description": "Enable Authorised Driver List",
+                "isEnabled": False,
+                "offset": 164
+            }
+            custom_parameters.append(new_param)
+            updated = True
+
+        if patch_assets and patch_tz and device.get('timeZoneId') != group_tz:
+            device['timeZoneId'] = group_tz
+            updated = True
+        return updated
+
+    filtered_devices = []
+    updated_devices = []
+    for device in devices:
+        if patch(device):
+            updated_devices.append(device)
+
+        all_devices = {
+            'id': device.get('id'),
+            'serialNumber': device.get('serialNumber')
+        }
+
+        filtered_devices.append(all_devices)
+    patch_entities(api, 'Device', updated_devices, patch, batcher)
+    return filtered_devices
+
+@instrumented('insert_devices')
+def insert_devices(conn, group_id, devices):
+    new_devices = []
     try:
-        create_table(conn, f"devices_{group_id}", "serialNumber TEXT PRIMARY KEY, deviceId TEXT", "serialNumber")
-        logging.info(f"Fetching devices for group ID: {group_id}")
-        now_utc = datetime.now(timezone.utc)
-        devices = api.get('Device', search={'groups': [{'id': group_id}], "fromDate": now_utc})
-        filtered_devices = []
-        for device in devices:
-            updated = False
-            custom_parameters = device.get('customParameters', [])
-            if add and not any(param.get('description') == "Enable Authorised Driver List" for param in custom_parameters):
-                new_param = {
-                    "bytes": "CA==",
-                    "description": "Enable Authorised Driver List",
-                    "isEnabled": False,
-                    "offset": 164
-                }
-                custom_parameters.append(new_param)
-                updated = True
-
-                # Update the device with the new custom parameter
-            group_tz = os.getenv(f"{group_name}", 'America/Vancouver')
-            if patch_assets and patch_tz and device.get('timeZoneId') != group_tz:
-                device['timeZoneId'] = group_tz
-                updated = True
-            
-            if  updated:
-
-   
-                updated_device = device.copy()
-                updated_device['customParameters'] = custom_parameters
+        stage(conn, 'staged_devices', "deviceId TEXT, serialNumber TEXT",
+              [(device['id'], device['serialNumber']) for device in devices])
+        inserted = conn.execute(f'''
+            INSERT OR IGNORE INTO devices_{group_id} (deviceId, serialNumber)
+            SELECT deviceId, serialNumber FROM temp.staged_devices ORDER BY rowid
+            RETURNING deviceId
+        ''').fetchall()
+        new_devices = [row[0] for row in inserted]
+        logging.debug(f"Devices inserted for group {group_id}: {new_devices}")
+        return new_devices
+    except sqlite3.Error as e:
+        logging.error(f"Error inserting devices for group {group_id}: {e}")
+        raise
 
-                try:
-                    api.set('Device', updated_device)
-                    logging.info(f"Updated device {device['name']}")
-                except Exception as e:
-                    logging.error(f"Failed to update device {device['id']}: {e}")
 
-            all_devices = {
-                'id': device.get('id'),
-                'serialNumber': device.get('serialNumber')
-            }
+@instrumented('remove_old_devices')
+def remove_old_devices(conn, group_id, current_device_ids):
+    removed_devices=[]
+    try:
+        stage(conn, 'staged_serials', "serialNumber TEXT PRIMARY KEY", [(serial_number,) for serial_number in current_device_ids])
+        removed_devices_tuples = conn.execute(f'''
+            DELETE FROM devices_{group_id} WHERE NOT EXISTS (
+                SELECT 1 FROM temp.staged_serials s WHERE s.serialNumber = devices_{group_id}.serialNumber
+            )
+            RETURNING deviceId
+        ''').fetchall()
+        removed_devices = [device[0] for device in removed_devices_tuples]
+        return removed_devices
+    except sqlite3.Error as e:
+        logging.error(f"Error removing old devices for group {group_id}: {e}")
+        raise
 
-            filtered_devices.append(all_devices)
-        del(devices)
-        if add:
-            new_devices = insert_devices(conn, group_id, filtered_devices)
-            return filtered_devices, new_devices
-        else:
-            removed_devices = remove_old_devices(conn, group_id, [device['serialNumber'] for device in filtered_devices])
-            return removed_devices
-    except Exception as e:
-        logging.error(f"Unexpected error fetching devices for group {group_id}: {e}")
-        raise MyGeotabException({"errors": [{"name": "UnexpectedError", "message": str(e)}]})
+class MultiCallBatcher:
+    """
+    Shared send queue that packs Add TextMessage calls from every device and group into full multi_calls.
+
+    Callers submit single calls and get a Future back; a background thread sends a batch as soon as
+    it reaches batch_size or the oldest queued call has waited max_wait seconds. Each Future resolves
+    to that call's own result, so a (device, key) pair can be marked sent or failed individually.
+    A batch the server rejects because of one of its calls is split in half and resent, so one bad call
+    does not fail the other calls packed with it. Connection errors and timeouts are retried with backoff;
+    when they persist, or the call ran out of rate limit retries or its session could not be renewed,
+    every call in the batch fails with that error rather than being split into more requests.
+    """
 
-        return [], []
+    def __init__(self, api, batch_size=50, max_wait=0.5, retries=3, delay=2):
+        self.api = api
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.retries = retries
+        self.delay = delay
+        self._pending = []
+        self._oldest = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="multicall-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, call):
+        """Queue one [method, params] call and return a Future for its result."""
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("MultiCallBatcher is closed")
+            if not self._pending:
+                self._oldest = monotonic()
+            self._pending.append((call, future))
+            # Wake the sender to start the max_wait clock on the first call, and to send a full batch
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                self._condition.notify()
+        return future
+
+    def close(self):
+        """Send whatever is still queued and stop the background thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _next_batch(self):
+        """Wait for the next batch to send; None once the batcher is closed and empty."""
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            if not self._pending and self._closed:
+                return None
+            while len(self._pending) < self.batch_size and not self._closed:
+                remaining = self._oldest + self.max_wait - monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            self._oldest = monotonic() if self._pending else None
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._send(batch, self.retries)
+
+    def _send(self, batch, retries):
+        calls = [call for call, _ in batch]
+        for attempt in range(retries):
+            try:
+                if attempt:
+                    metrics.retry('multicall_batch')
+                metrics.batch(len(calls))
+                results = self.api.multi_call(calls)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+                logging.debug(f"Sent multi_call batch of {len(calls)} calls")
+                return
+            except Exception as e:
+                error = e
+                logging.error(f"Unexpected error while sending multi_call batch of {len(calls)} calls on attempt {attempt + 1}: {e}")
+                if is_final(e):
+                    break
+                if attempt < retries - 1:
+                    sleep(backoff_delay(attempt, base=self.delay))
+        if self._should_split(batch, error):
+            middle = len(batch) // 2
+            self._send(batch[:middle], 1)
+            self._send(batch[middle:], 1)
+
+    def _should_split(self, batch, error):
+        """After the last attempt: split a batch the server rejected over one of its calls, otherwise fail every call with the error."""
+        if is_call_rejected(error) and len(batch) > 1:
+            return True
+        for _, future in batch:
+            future.set_exception(error)
+        return False
+
+class AsyncMultiCallBatcher(MultiCallBatcher):
+    """
+    MultiCallBatcher that keeps up to `in_flight` multi_calls going at once with the asyncio client.
 
+    submit() and close() are unchanged, so the group workers, the patches and execute_plan use it as they
+    use MultiCallBatcher. The background thread runs an event loop instead: every batch is sent by its
+    own coroutine, and the next batch is only taken off the queue when one of the `in_flight` slots is
+    free, so calls keep filling it while the server is busy. Failing batches are split or failed the
+    same way, so every call still gets its own result.
+    """
 
+    def __init__(self, api, in_flight, batch_size=50, max_wait=0.5, retries=3, delay=2):
+        self.async_api = AsyncRateLimitedAPI.from_credentials(api.credentials)
+        self.in_flight = in_flight
+        super().__init__(api, batch_size=batch_size, max_wait=max_wait, retries=retries, delay=delay)
+
+    def _run(self):
+        asyncio.run(self._dispatch())
+
+    async def _dispatch(self):
+        slots = asyncio.Semaphore(self.in_flight)
+        tasks = set()
+        while True:
+            await slots.acquire()
+            # Waiting for calls blocks on the queue's condition, so it runs off the event loop
+            batch = await asyncio.to_thread(self._next_batch)
+            if batch is None:
+                break
+            task = asyncio.create_task(self._send_async(batch, self.retries))
+            tasks.add(task)
+            task.add_done_callback(lambda task: (tasks.discard(task), slots.release()))
+        await asyncio.gather(*tasks)
+
+    async def _send_async(self, batch, retries):
+        calls = [call for call, _ in batch]
+        for attempt in range(retries):
+            try:
+                if attempt:
+                    metrics.retry('multicall_batch')
+                metrics.batch(len(calls))
+                results = await self.async_api.multi_call_async(calls)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+                logging.debug(f"Sent multi_call batch of {len(calls)} calls")
+                return
+            except Exception as e:
+                error = e
+                logging.error(f"Unexpected error while sending multi_call batch of {len(calls)} calls on attempt {attempt + 1}: {e}")
+                if is_final(e):
+                    break
+                if attempt < retries - 1:
+                    await asyncio.sleep(backoff_delay(attempt, base=self.delay))
+        if self._should_split(batch, error):
+            middle = len(batch) // 2
+            await asyncio.gather(self._send_async(batch[:middle], 1), self._send_async(batch[middle:], 1))
+
+def create_batcher(api):
+    """The shared send queue: asyncio with ASYNC_IN_FLIGHT multi_calls at once, or one at a time when it is 0."""
+    if async_in_flight > 0:
+        return AsyncMultiCallBatcher(api, async_in_flight, batch_size=multicall_batch_size, max_wait=multicall_max_wait)
+    return MultiCallBatcher(api, batch_size=multicall_batch_size, max_wait=multicall_max_wait)
+
+@instrumented('set_entities')
+def set_entities(api, type_name, entities, batcher=None, retries=2):
+    """
+    Patch many entities with batched Set multi_calls instead of one api.set per entity.
 
+    Each entity's Set is queued on the batcher, which packs them into multi_calls and narrows a failing
+    batch down to the entities that caused it. Only the entities that failed are queued again.
 
+    Parameters:
+    api (object): The API object, used when no batcher is given.
+    type_name (str): The entity type, e.g. 'Device' or 'User'.
+    entities (list): The updated entities to set.
+    batcher (MultiCallBatcher): Optional shared send queue; a private one is used when omitted.
+    retries (int): How many rounds of resending the failed entities. Default is 2.
 
-def insert_devices(conn, group_id, devices):
-    new_devices = []
-    try:
-        with conn:
-            c = conn.cursor()
-            for device in devices:
-                c.execute(f'''
-                    INSERT OR IGNORE INTO devices_{group_id} (deviceId, serialNumber) VALUES (?, ?)
-                ''', (device['id'], device['serialNumber']))
-                if c.rowcount > 0:
-                    new_devices.append(device['id'])
-        logging.debug(f"Devices inserted for group {group_id}: {new_devices}")
-        if new_devices:    
-            add_columns(conn, group_id, new_devices)
-        return new_devices
-    except sqlite3.Error as e:
-        logging.error(f"Error inserting devices for group {group_id}: {e}")
+    Returns:
+    list: The entities that still failed after every retry.
+    """
+    if not entities:
+        return []
+    if dry_run:
+        logging.info(f"Dry run: would update {len(entities)} {type_name} entities")
         return []
+    own_batcher = batcher is None
+    if own_batcher:
+        batcher = create_batcher(api)
+    try:
+        remaining = list(entities)
+        errors = {}
+        for attempt in range(retries):
+            futures = [(entity, batcher.submit(['Set', {"typeName": type_name, "entity": entity}])) for entity in remaining]
+            failed = []
+            for entity, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors[entity['id']] = e
+                    failed.append(entity)
+            if failed and attempt < retries - 1:
+                logging.warning(f"Retrying {len(failed)} of {len(remaining)} {type_name} updates")
+                metrics.retry(f"set_{type_name.lower()}", len(failed))
+            remaining = failed
+            if not remaining:
+                break
+        for entity in remaining:
+            logging.error(f"Failed to update {type_name} {entity['id']}: {errors[entity['id']]}")
+        logging.info(f"Updated {len(entities) - len(remaining)} of {len(entities)} {type_name} entities")
+        return remaining
+    finally:
+        if own_batcher:
+            batcher.close()
+
+@instrumented('patch_entities')
+def patch_entities(api, type_name, entities, patch, batcher=None):
+    """
+    Apply a patch to entities that were fetched with a propertySelector and Set them.
 
+    A Set replaces the whole entity, so each entity is fetched again in full (a batched Get by id) and
+    the patch is applied to the full copy before it is sent. Only entities the patch changed on the
+    partial copy are passed in, so full entities are downloaded just for the records being updated.
 
-def add_columns(conn, group_id, columns):
+    Parameters:
+    api (object): The API object, used when no batcher is given.
+    type_name (str): The entity type, e.g. 'Device' or 'User'.
+    entities (list): The partial entities that need the patch.
+    patch (function): Modifies an entity in place and returns whether it changed anything.
+    batcher (MultiCallBatcher): Optional shared send queue; a private one is used when omitted.
+
+    Returns:
+    list: The entities that failed to update.
     """
-    Adds new columns named by device id to a group's keys table in the database. When a column is added
-    it is default 0, meaning that if our api fails during it loop and isn't able to update the row to
-    1 we can retry
+    if not entities:
+        return []
+    if dry_run:
+        logging.info(f"Dry run: would update {len(entities)} {type_name} entities")
+        return []
+    own_batcher = batcher is None
+    if own_batcher:
+        batcher = create_batcher(api)
+    try:
+        futures = [(entity, batcher.submit(['Get', {"typeName": type_name, "search": {"id": entity['id']}}])) for entity in entities]
+        full_entities = []
+        failed = []
+        for entity, future in futures:
+            try:
+                found = future.result()
+            except Exception as e:
+                logging.error(f"Failed to fetch {type_name} {entity['id']} for update: {e}")
+                failed.append(entity)
+                continue
+            if found and patch(found[0]):
+                full_entities.append(found[0])
+        return failed + set_entities(api, type_name, full_entities, batcher)
+    finally:
+        if own_batcher:
+            batcher.close()
+
+def key_message(vehicle_to_update, key, add=True):
+    """Build the TextMessage that adds a key to, or removes it from, a vehicle's authorization list."""
+    return {
+        "device": {
+            "id": vehicle_to_update
+        },
+        "isDirectionToVehicle": True,
+        "messageContent": {
+            "driverKey": key,
+            "contentType": "DriverAuthList",
+            "clearAuthList": False,
+            "addToAuthList": add
+        }
+    }
+
+def clear_message(vehicle_to_update):
+    """Build the TextMessage that clears a vehicle's whole authorization list."""
+    #Can't iterate over null and call fails with clearauthlist = true even with an empty array, needs specifically to be null
+    return {
+        "device": {
+            "id": vehicle_to_update
+        },
+        "isDirectionToVehicle": True,
+        "messageContent": {
+            "driverKey": None,
+            "contentType": "DriverAuthList",
+            "clearAuthList": True,
+            "addToAuthList": False
+        }
+    }
+
+def is_delivered(message):
+    delivered = message.get('delivered')
+    # Undelivered messages come back without a date or with MyGeotab's minimum date
+    return hasattr(delivered, 'year') and delivered.year > 2000
+
+def record_delivery_latency(conn, texts):
+    """Time from planning to delivery of every delivered message sent from the plan, per priority, for the run metrics."""
+    if not texts:
+        return
+    stage(conn, 'staged_delivered', "message_id TEXT PRIMARY KEY, delivered TEXT", [(text['id'], text['delivered'].isoformat()) for text in texts])
+    rows = conn.execute('''
+        SELECT p.priority, p.created_at, d.delivered FROM temp.staged_delivered d JOIN sync_plan p ON p.message_id = d.message_id
+        WHERE p.created_at IS NOT NULL
+    ''')
+    for priority, planned_at, delivered_at in rows:
+        metrics.latency(f"delivered {priority}", (datetime.fromisoformat(delivered_at) - datetime.fromisoformat(planned_at)).total_seconds())
+
+@instrumented('search_texts')
+def search_texts(api, conn):
+    """
+    Reconcile the state of sent keys with the delivery status of their DriverAuthList TextMessages.
 
-    This function checks the existing columns in the `keys_{group_id}` table and adds any missing 
-    columns from the provided list of columns.
+    TextMessage changes are read with GetFeed from the version stored in feed_versions, so each run only
+    downloads messages sent or delivered since the last one (the first run looks back DELIVERY_LOOKBACK_DAYS).
+    Keys whose message has been delivered move from pending to delivered in one bulk update. Keys still
+    pending after DELIVERY_TIMEOUT_DAYS go back to unsent so plan_vehicles sends them again; everything
+    else that is pending is left alone, so messages still queued for an offline vehicle are not duplicated.
+    Messages sent by a run that died before recording them are matched to their sync_plan rows on the way.
 
     Parameters:
+    api (object): The API object used to call GetFeed.
     conn (object): The database connection object.
-    group_id (str): The ID of the group whose keys table is being modified.
-    columns (list): A list of column names to be added.
 
     Returns:
-    None
+    tuple: The number of keys marked delivered, the number of keys marked for resending, and whether the
+    feed was read to the end. Only then is it safe to requeue_in_doubt.
 
     Raises:
-    sqlite3.Error: Logs any SQLite errors encountered during the process.
+    Exception: Logs any errors and returns the counts so far, with the feed marked unread.
     """
-    
-    
+    delivered_count = 0
+    expired_count = 0
+    resumed_count = 0
+    reconciled = False
     try:
+        version = get_feed_version(conn, 'TextMessage')
+        parameters = dict(type_name='TextMessage', from_version=version, results_limit=feed_results_limit)
+        if version is None:
+            parameters['search'] = {'fromDate': datetime.now(timezone.utc) - timedelta(days=delivery_lookback_days)}
+        while True:
+            result = api.call('GetFeed', **parameters)
+            texts = result.get('data', [])
+            parameters['from_version'] = result.get('toVersion')
+            parameters.pop('search', None)
+            resumed_count += resolve_in_doubt(conn, texts)
+            delivered = [
+                (KEY_STATE_DELIVERED, datetime.now(timezone.utc).isoformat(), text['id'], KEY_STATE_PENDING)
+                for text in texts
+                if text.get('messageContent', {}).get('contentType') == "DriverAuthList" and is_delivered(text)
+            ]
+            record_delivery_latency(conn, [text for text in texts if is_delivered(text)])
+            with conn:
+                cursor = conn.executemany('''
+                    UPDATE key_device_status SET state = ?, updated_at = ? WHERE message_id = ? AND state = ?
+                ''', delivered)
+                delivered_count += max(cursor.rowcount, 0)
+                conn.execute('''
+                    INSERT OR REPLACE INTO feed_versions (type_name, to_version, updated_at) VALUES (?, ?, ?)
+                ''', ('TextMessage', parameters['from_version'], datetime.now(timezone.utc).isoformat()))
+            if len(texts) < feed_results_limit:
+                break
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=delivery_timeout_days)).isoformat()
         with conn:
-            cursor = conn.cursor()
-            # Get the current columns in the table
-            cursor.execute(f"PRAGMA table_info(keys_{group_id})")
-            current_columns = [info[1] for info in cursor.fetchall()]
-
-            for column in columns:
-                if column not in current_columns:
-                    cursor.execute(f'''
-                        ALTER TABLE keys_{group_id} ADD COLUMN {column} INTEGER DEFAULT 0
-                    ''')
-                    logging.debug(f"Added missing column {column} to keys_{group_id}")
-                else:
-                    logging.debug(f"Column {column} already exists in keys_{group_id}")
-    except sqlite3.Error as e:
-        logging.error(f"Error adding columns to keys_{group_id}: {e}")
-
-
-def remove_old_devices(conn, group_id, current_device_ids):
-    removed_devices=[]
-    try:
-        c = conn.cursor()
-        placeholders = ','.join('?' for _ in current_device_ids)
-        query = f'''
-            DELETE FROM devices_{group_id} WHERE serialNumber NOT IN ({placeholders})
-            RETURNING deviceId
-        '''
-        c.execute(query, current_device_ids)
-        removed_devices_tuples = c.fetchall()
-        conn.commit()
-        removed_devices = [device[0] for device in removed_devices_tuples]
-        if removed_devices:
-            remove_columns(conn, group_id, removed_devices)
-
-        return removed_devices
-    except sqlite3.Error as e:
-        logging.error(f"Error removing old devices for group {group_id}: {e}")
-        return []
+            cursor = conn.execute('''
+                UPDATE key_device_status SET state = ?, updated_at = ?
+                WHERE state = ? AND message_id IS NOT NULL AND updated_at < ?
+            ''', (KEY_STATE_UNSENT, datetime.now(timezone.utc).isoformat(), KEY_STATE_PENDING, cutoff))
+            expired_count = cursor.rowcount
+        logging.info(f"Delivery reconciliation: {delivered_count} keys delivered, {expired_count} undelivered keys queued to resend")
+        if resumed_count:
+            logging.info(f"Found {resumed_count} messages sent by an interrupted run")
+        reconciled = True
+    except Exception as e:
+        metrics.error()
+        logging.error(f"Error reconciling text message deliveries: {e}")
+    return delivered_count, expired_count, reconciled
 
-def remove_columns(conn, group_id, columns_to_remove):
+        
+###Sync plan ##################################################################################################################################################
+# A run is split in two. The group workers only work out what has to change and store it in sync_plan; execute_plan then sends it
+# in large batches. A crash or a failed send leaves the rest of the plan in the table for the next run (or for --execute-only)
+# instead of leaving the local tables and the vehicles out of step, and --dry-run can show the plan without sending anything.
+#
+# sync_plan is also the run's journal. A row is 'planned' in the same transaction as the key/device table change it comes from,
+# 'sending' is committed before its message is queued, and 'sent'/'failed' once the server has answered. After a crash the
+# rows left 'sending' are matched against the TextMessage feed (resolve_in_doubt) and only the ones the server never received
+# go back to 'planned', so nothing is lost and nothing is sent twice.
+PLAN_ADD = 'add'
+PLAN_REMOVE = 'remove'
+PLAN_CLEAR = 'clear'
+PLAN_PLANNED = 'planned'
+PLAN_SENDING = 'sending'
+# Kinds of operation, in the order execute_plan sends them: a new key for a vehicle that already has its list, removals
+# (and clears of vehicles that left every group), operations that failed or were never sent before, and whole lists
+# for new vehicles and rebuilds. PLAN_SHARES sets how much of each chunk every kind gets.
+PRIORITY_NEW_KEY = 'new_key'
+PRIORITY_REMOVE = 'remove'
+PRIORITY_RETRY = 'retry'
+PRIORITY_FULL_LOAD = 'full_load'
+PLAN_PRIORITIES = (PRIORITY_NEW_KEY, PRIORITY_REMOVE, PRIORITY_RETRY, PRIORITY_FULL_LOAD)
+
+def create_plan_table(conn):
     """
-    Remove specified columns from a database table for a specific group.
+    Create the sync_plan table and its indexes.
 
-    This function modifies the table schema by creating a new table without the specified columns, 
-    copying the data from the old table to the new table, dropping the old table, 
-    and renaming the new table to the original table name. This is necessary as sqlite does not have a
-    drop column function
+    Only one copy of an operation can be planned for a vehicle at a time, whichever group it came from,
+    so a key that is still planned from an earlier run is not planned again when it is retried.
 
     Parameters:
     conn (object): The database connection object.
-    group_id (str): The ID of the group whose table columns are to be modified.
-    columns_to_remove (list): A list of column names to be removed from the table.
 
     Returns:
     None
@@ -508,330 +1725,975 @@ def remove_columns(conn, group_id, columns_to_remove):
     """
     try:
         with conn:
-            cursor = conn.cursor()
-
-            # Get the current columns in the table
-            cursor.execute(f"PRAGMA table_info(keys_{group_id})")
-            current_columns_info = cursor.fetchall()
-            current_columns = [info[1] for info in current_columns_info]
-
-            # Determine the columns to keep
-            columns_to_keep = [col for col in current_columns if col not in columns_to_remove]
-
-            # Generate the new table schema without the columns to remove
-            new_table_schema = ', '.join(columns_to_keep)
-            old_table = f"keys_{group_id}"
-            new_table = f"{old_table}_new"
-
-            # Get the current column definitions
-            column_definitions = ', '.join([
-                f"{info[1]} {info[2]} {'PRIMARY KEY' if info[5] else ''} {'NOT NULL' if info[3] else ''}"
-                for info in current_columns_info if info[1] in columns_to_keep
-            ])
-
-            # Create a new table with the remaining columns
-            create_query = f'''
-                CREATE TABLE {new_table} ({column_definitions})
-            '''
-            logging.debug(f"Create query: {create_query}")
-            cursor.execute(create_query)
-
-            # Copy data from the old table to the new table
-            copy_data_query = f'''
-                INSERT INTO {new_table} ({new_table_schema})
-                SELECT {new_table_schema} FROM {old_table}
-            '''
-            logging.debug(f"Copy data query: {copy_data_query}")
-            cursor.execute(copy_data_query)
-
-            # Drop the old table
-            cursor.execute(f"DROP TABLE {old_table}")
-
-            # Rename the new table to the original table name
-            cursor.execute(f"ALTER TABLE {new_table} RENAME TO {old_table}")
-
-        logging.debug(f"Removed columns from keys_{group_id}: {columns_to_remove}")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sync_plan (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    run_id TEXT NOT NULL,
+                    group_id TEXT NOT NULL,
+                    device_id TEXT NOT NULL,
+                    action TEXT NOT NULL,
+                    serial_number TEXT,
+                    driver_key TEXT,
+                    status TEXT NOT NULL DEFAULT 'planned',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    message_id TEXT,
+                    created_at TEXT,
+                    updated_at TEXT,
+                    priority TEXT NOT NULL DEFAULT 'retry'
+                );
+            ''')
+            # Operations planned before there were priorities are left over from earlier runs, i.e. retries
+            if 'priority' not in {row[1] for row in conn.execute("PRAGMA table_info(sync_plan)")}:
+                conn.execute(f"ALTER TABLE sync_plan ADD COLUMN priority TEXT NOT NULL DEFAULT '{PRIORITY_RETRY}'")
+            # Plans from before vehicles were planned across groups could hold the same operation once per group
+            conn.execute("DROP INDEX IF EXISTS idx_sync_plan_planned")
+            conn.execute('''
+                DELETE FROM sync_plan WHERE status = 'planned' AND id NOT IN (
+                    SELECT MIN(id) FROM sync_plan WHERE status = 'planned' GROUP BY device_id, action, COALESCE(serial_number, '')
+                )
+            ''')
+            conn.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_sync_plan_device
+                ON sync_plan (device_id, action, COALESCE(serial_number, '')) WHERE status = 'planned'
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_sync_plan_status ON sync_plan (status, id)
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_sync_plan_priority ON sync_plan (priority, id) WHERE status = 'planned'
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_sync_plan_message ON sync_plan (message_id)
+            ''')
     except sqlite3.Error as e:
-        logging.error(f"Error removing columns from keys_{group_id}: {e}")
+        logging.error(f"Error creating sync_plan table: {e}")
+
+def prune_plan(conn, days=7):
+    """Drop finished plan rows older than `days`; planned rows are always kept."""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+    with conn:
+        conn.execute("DELETE FROM sync_plan WHERE status != 'planned' AND updated_at < ?", (cutoff,))
 
-def update_device_column(conn, group_id, serial_number, column, value):
+@instrumented('plan_operations')
+def plan_operations(conn, run_id, group_id, device_id, action, keys, priority=PRIORITY_FULL_LOAD):
     """
-    Update a specific column value for a device in the group's keys table.
+    Add operations for one device to the sync plan.
 
-    This function updates the value of a specified device id column and the current
-    key's serial number for the row identifier
-    in the `keys_{group_id}` table.
+    While a clear is still planned for the device, the new operations take the clear's priority, so they
+    are sent after it rather than overtaking it and being wiped by it.
 
     Parameters:
     conn (object): The database connection object.
-    group_id (str): The ID of the group whose keys table is being updated.
-    serial_number (str): The serial number of the key row to be updated.
-    column (str): The name of the column to be updated.
-    value (any): The new value to set for the specified column.
+    run_id (str): The run that planned the operations.
+    group_id (str): The ID of the group the operations are for.
+    device_id (str): The ID of the vehicle.
+    action (str): PLAN_ADD, PLAN_REMOVE or PLAN_CLEAR.
+    keys (list): The keys to add or remove; ignored for PLAN_CLEAR.
+    priority (str): One of PLAN_PRIORITIES. Default is PRIORITY_FULL_LOAD.
 
     Returns:
-    None
+    int: The number of operations added; those already planned from an earlier run are not counted.
 
     Raises:
-    sqlite3.Error: Logs any SQLite errors encountered during the update process.
+    sqlite3.Error: Logs and re-raises any SQLite errors, so the caller rolls back the group's changes.
     """
-    
-    
+    keys = [None] if action == PLAN_CLEAR else keys
+    planned_at = datetime.now(timezone.utc).isoformat()
     try:
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute(f'''
-                UPDATE keys_{group_id}
-                SET {column} = ?
-                WHERE serialNumber = ?
-            ''', (value, serial_number))
+        clear = conn.execute("SELECT priority FROM sync_plan WHERE status = ? AND device_id = ? AND action = ?",
+                             (PLAN_PLANNED, device_id, PLAN_CLEAR)).fetchone()
+        priority = clear[0] if clear else priority
+        changes = conn.total_changes
+        # Committed by the worker together with the key and device table changes the operations come from
+        conn.executemany('''
+            INSERT OR IGNORE INTO sync_plan (run_id, group_id, device_id, action, serial_number, driver_key, created_at, updated_at, priority)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(run_id, group_id, device_id, action, key['serialNumber'] if key else None,
+               json.dumps(key) if key else None, planned_at, planned_at, priority) for key in keys])
+        return conn.total_changes - changes
     except sqlite3.Error as e:
-        logging.error(f"Error updating column {column} in keys_{group_id}: {e}")
+        logging.error(f"Error planning {action} for device {device_id} in group {group_id}: {e}")
+        raise
+
+def plan_rebuild(conn, run_id, group_id, device_id, keys):
+    """
+    Plan a clear of a vehicle's auth list followed by every key it should have.
 
+    Adds and removes still planned for the vehicle are dropped, the rebuild covers them.
 
-def send_text_message(api, vehicle_to_update, Keys, group_id, conn, add=True, clear=False, Time=0, retries=3, delay=5):
+    Parameters:
+    conn (object): The database connection object.
+    run_id (str): The run that planned the operations.
+    group_id (str): The group the operations are recorded under.
+    device_id (str): The ID of the vehicle.
+    keys (list): Every key the vehicle should have.
+
+    Returns:
+    int: The number of messages planned.
+    """
+    conn.execute('''
+        DELETE FROM sync_plan WHERE status = ? AND device_id = ? AND action IN (?, ?)
+    ''', (PLAN_PLANNED, device_id, PLAN_ADD, PLAN_REMOVE))
+    conn.execute("DELETE FROM key_device_status WHERE device_id = ?", (device_id,))
+    mark_unsent(conn, device_id, keys)
+    return plan_operations(conn, run_id, group_id, device_id, PLAN_CLEAR, []) + plan_operations(conn, run_id, group_id, device_id, PLAN_ADD, keys)
+
+@instrumented('collapse_plan')
+def collapse_plan(conn):
+    """
+    Drop planned add/remove pairs for the same key and vehicle, which cancel each other out.
+
+    A pair arises when a key leaves and comes back (or the reverse) while one half is still planned,
+    e.g. left over from a failed run. A planned clear of the vehicle between the two keeps both.
+    When the add came last the key is still on the vehicle, so its status row goes back to pending.
+
+    Parameters:
+    conn (object): The database connection object.
+
+    Returns:
+    int: The number of operations dropped.
+    """
+    # Literal 'planned' so SQLite can use the partial index
+    pairs = conn.execute('''
+        SELECT r.id, a.id, r.device_id, r.serial_number FROM sync_plan r
+        JOIN sync_plan a INDEXED BY idx_sync_plan_device ON a.status = 'planned' AND a.device_id = r.device_id AND a.action = ?
+            AND COALESCE(a.serial_number, '') = COALESCE(r.serial_number, '')
+        WHERE r.status = 'planned' AND r.action = ?
+            AND NOT EXISTS (
+                SELECT 1 FROM sync_plan c WHERE c.status = 'planned' AND c.device_id = r.device_id
+                    AND c.action = ? AND COALESCE(c.serial_number, '') = '' AND c.id BETWEEN MIN(a.id, r.id) AND MAX(a.id, r.id)
+            )
+    ''', (PLAN_ADD, PLAN_REMOVE, PLAN_CLEAR)).fetchall()
+    if not pairs:
+        return 0
+    conn.executemany("DELETE FROM sync_plan WHERE id = ?", [(plan_id,) for pair in pairs for plan_id in pair[:2]])
+    updated_at = datetime.now(timezone.utc).isoformat()
+    # Same convention as keys migrated from the old tables: believed to be on the vehicle, no message to confirm
+    conn.executemany('''
+        INSERT INTO key_device_status (device_id, serial_number, state, updated_at, message_id) VALUES (?, ?, ?, ?, NULL)
+        ON CONFLICT (device_id, serial_number) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at, message_id = NULL
+    ''', [(device_id, serial_number, KEY_STATE_PENDING, updated_at)
+          for remove_id, add_id, device_id, serial_number in pairs if add_id > remove_id])
+    conn.executemany("DELETE FROM key_device_status WHERE device_id = ? AND serial_number = ?",
+                     [(device_id, serial_number) for remove_id, add_id, device_id, serial_number in pairs if add_id < remove_id])
+    logging.info(f"Collapsed {len(pairs)} add/remove pairs")
+    return len(pairs) * 2
+
+def plan_message(action, device_id, driver_key):
+    if action == PLAN_CLEAR:
+        return clear_message(device_id)
+    return key_message(device_id, json.loads(driver_key), add=action == PLAN_ADD)
+
+def plan_action(content):
+    """The sync_plan action a DriverAuthList message content carries out."""
+    if content.get('clearAuthList'):
+        return PLAN_CLEAR
+    return PLAN_ADD if content.get('addToAuthList') else PLAN_REMOVE
+
+def resolve_in_doubt(conn, texts):
+    """
+    Match operations left 'sending' by an interrupted run against DriverAuthList TextMessages from the feed.
+
+    An operation whose message the server did receive is marked sent with that message's id (and an added
+    key becomes pending), so requeue_in_doubt does not send it again.
+
+    Parameters:
+    conn (object): The database connection object.
+    texts (list): TextMessages from the feed.
+
+    Returns:
+    int: The number of operations found to have been sent.
     """
-    Send a text message to update the authorization list of a vehicle.
+    if not conn.execute("SELECT 1 FROM sync_plan WHERE status = ? LIMIT 1", (PLAN_SENDING,)).fetchone():
+        return 0
+    resolved = []
+    updated_at = datetime.now(timezone.utc).isoformat()
+    with conn:
+        for text in texts:
+            content = text.get('messageContent', {})
+            if content.get('contentType') != "DriverAuthList":
+                continue
+            driver_key = content.get('driverKey') or {}
+            action = plan_action(content)
+            row = conn.execute('''
+                UPDATE sync_plan SET status = 'sent', message_id = ?, updated_at = ?
+                WHERE id = (
+                    SELECT id FROM sync_plan WHERE status = ? AND device_id = ? AND action = ? AND COALESCE(serial_number, '') = ?
+                    ORDER BY id LIMIT 1
+                )
+                RETURNING group_id, device_id, action, serial_number
+            ''', (text['id'], updated_at, PLAN_SENDING, text.get('device', {}).get('id'), action,
+                  '' if action == PLAN_CLEAR else driver_key.get('serialNumber', ''))).fetchone()
+            if row:
+                resolved.append(row + (text['id'],))
+        conn.executemany('''
+            UPDATE key_device_status SET state = ?, updated_at = ?, message_id = ? WHERE device_id = ? AND serial_number = ?
+        ''', [(KEY_STATE_PENDING, updated_at, message_id, device_id, serial_number)
+              for group_id, device_id, action, serial_number, message_id in resolved if action == PLAN_ADD])
+    return len(resolved)
+
+def requeue_in_doubt(conn):
+    """
+    Put operations still 'sending' after resolve_in_doubt back in the plan; the server never received them.
 
-    This function sends a text message to a specified vehicle to add or remove NFC keys 
-    from its authorization list. It handles retries in case of failure and updates the 
-    database accordingly.
+    Only call this once search_texts has read the whole feed. Otherwise a message that did arrive may not
+    have been matched yet and would be sent twice; the rows are left 'sending' for the next run instead.
 
     Parameters:
-    api (object): The API object used to send messages.
-    vehicle_to_update (str): The ID of the vehicle to update.
-    Keys (list): A list of keys to add or remove from the vehicle's authorization list.
-    group_id (str): The ID of the group associated with the vehicle.
     conn (object): The database connection object.
-    add (bool): Indicates whether to add (True) or remove (False) the keys. Default is True.
-    clear (bool): Indicates whether to clear the authorization list. Default is False.
-    Time (int): The delay time in seconds between sending messages. Default is 0.
-    retries (int): The number of retry attempts in case of failure. Default is 3.
-    delay (int): The delay time in seconds between retry attempts. Default is 5.
+
+    Returns:
+    int: The number of operations requeued.
+    """
+    with conn:
+        # A row of the same operation planned meanwhile is the same message, so it is replaced rather than duplicated
+        cursor = conn.execute("UPDATE OR REPLACE sync_plan SET status = ?, updated_at = ? WHERE status = ?",
+                              (PLAN_PLANNED, datetime.now(timezone.utc).isoformat(), PLAN_SENDING))
+    if cursor.rowcount:
+        logging.warning(f"Requeued {cursor.rowcount} operations left unsent by an interrupted run")
+    return cursor.rowcount
+
+def reconcile_in_doubt(api, conn):
+    """Read the TextMessage feed and requeue the operations it shows were never received, if it could be read."""
+    if search_texts(api, conn)[2]:
+        return requeue_in_doubt(conn)
+    in_doubt = conn.execute("SELECT COUNT(*) FROM sync_plan WHERE status = ?", (PLAN_SENDING,)).fetchone()[0]
+    if in_doubt:
+        logging.warning(f"Leaving {in_doubt} operations of an interrupted run unsent until delivery reconciliation succeeds")
+    return 0
+
+def record_plan_results(conn, results):
+    """
+    Store the outcome of one chunk of sent operations in a single transaction.
+
+    Sent operations are marked sent with their message id; added keys also become pending in
+    key_device_status. Until then the chunk's rows are 'sending', see resolve_in_doubt. Failed operations
+    stay planned for the next run, as retries, until they reach PLAN_MAX_ATTEMPTS; a failed add leaves its key unsent.
+    Keys whose status row is gone (removed or cleared since the add was planned) are not brought back.
+    A successful clear empties the vehicle's list, so every key it was known to have goes back to unsent
+    (and is sent again, see plan_vehicles) unless an add sent after the clear is in the same results.
+
+    Parameters:
+    conn (object): The database connection object.
+    results (list): (plan id, group id, device id, action, serial number, message id or None, error or None) tuples.
 
     Returns:
     None
+    """
+    updated_at = datetime.now(timezone.utc).isoformat()
+    with conn:
+        conn.executemany('''
+            UPDATE sync_plan SET
+                attempts = attempts + 1,
+                status = CASE WHEN ? IS NULL THEN 'sent' WHEN attempts + 1 >= ? THEN 'failed' ELSE 'planned' END,
+                priority = CASE WHEN ? IS NULL THEN priority ELSE ? END,
+                message_id = ?, updated_at = ?
+            WHERE id = ?
+        ''', [(error, plan_max_attempts, error, PRIORITY_RETRY, message_id, updated_at, plan_id)
+              for plan_id, _, _, _, _, message_id, error in results])
+        conn.executemany("UPDATE key_device_status SET state = ?, updated_at = ?, message_id = NULL WHERE device_id = ?",
+                         [(KEY_STATE_UNSENT, updated_at, device_id) for _, _, device_id, action, _, _, error in results
+                          if action == PLAN_CLEAR and not error])
+        conn.executemany('''
+            UPDATE key_device_status SET state = ?, updated_at = ?, message_id = ? WHERE device_id = ? AND serial_number = ?
+        ''', [(KEY_STATE_UNSENT if error else KEY_STATE_PENDING, updated_at, message_id, device_id, serial_number)
+              for _, group_id, device_id, action, serial_number, message_id, error in results if action == PLAN_ADD])
+
+def next_chunk(conn, started_at):
+    """
+    The next PLAN_CHUNK_SIZE planned operations, shared out between the priorities by PLAN_SHARES.
 
-    Raises:
-    MyGeotabException: Custom exception with error details if any issues occur during the process.
+    Each priority is read oldest first. While several have operations waiting, each gets its share of the
+    chunk, and a share one cannot fill goes to the others. Operations tried since `started_at` are skipped,
+    so a failure waits for the next run. The chunk is ordered by priority.
+
+    Parameters:
+    conn (object): The database connection object.
+    started_at (str): When execute_plan started, as an ISO timestamp.
+
+    Returns:
+    list: (id, group id, device id, action, serial number, driver key, priority, planned at) tuples.
     """
-    try:
-        calls = []
-        for key in Keys:
-            data = {
-            "device": {
-            "id": vehicle_to_update
-            },
-            "isDirectionToVehicle": True,
-            "messageContent": {
-            "driverKey": key,
-            "contentType": "DriverAuthList",
-            "clearAuthList": clear,
-            "addToAuthList": add
-                }
-            }
-            calls.append(['Add', {"typeName": 'TextMessage', "entity": data}])  
-            
-        if calls:
-            for attempt in range(retries):
-                try:
-                    if len(calls) <= 50:
-                        api.multi_call(calls)
-                    else:
-                        # Split into batches of 50
-                        for i in range(0, len(calls), 50):
-                            api.multi_call(calls[i:i + 50])
-                    action = "added to" if add else "removed from"
-                    logging.debug(f"Keys {action} device {vehicle_to_update} Keys: {Keys}")
-                    sleep(Time)
-                    break  # If successful, break out of the retry loop
-                except Exception as e:
-                    logging.error(f"Unexpected error while sending text messages to vehicle with ID: {vehicle_to_update} on attempt {attempt + 1}: {e}")
-                    if attempt < retries - 1:
-                        logging.info(f"Retrying in {delay} seconds...")
-                        sleep(delay)
-                    else:
-                        logging.error(f"Failed after {retries} attempts")
-                        raise MyGeotabException({"errors": [{"name": "UnexpectedError", "message": str(e)}]})
-            if add:
-                for key in Keys:
-                    update_device_column(conn, group_id, key['serialNumber'], vehicle_to_update, 1)
-        
-        if clear:
+    waiting = {
+        priority: conn.execute('''
+            SELECT id, group_id, device_id, action, serial_number, driver_key, priority, created_at
+            FROM sync_plan INDEXED BY idx_sync_plan_priority
+            WHERE status = 'planned' AND priority = ? AND updated_at < ? ORDER BY id LIMIT ?
+        ''', (priority, started_at, plan_chunk_size)).fetchall()
+        for priority in PLAN_PRIORITIES
+    }
+    taken = dict.fromkeys(PLAN_PRIORITIES, 0)
+    room = plan_chunk_size
+    while room:
+        open_priorities = [priority for priority in PLAN_PRIORITIES if taken[priority] < len(waiting[priority])]
+        if not open_priorities:
+            break
+        total = sum(plan_shares.get(priority, 1.0) for priority in open_priorities)
+        round_room = room
+        for priority in open_priorities:
+            count = min(max(1, int(round_room * plan_shares.get(priority, 1.0) / total)), len(waiting[priority]) - taken[priority], room)
+            taken[priority] += count
+            room -= count
+    return [row for priority in PLAN_PRIORITIES for row in waiting[priority][:taken[priority]]]
+
+def uncleared_devices(conn, device_ids):
+    """The vehicles among device_ids that still have a clear planned, which must go out before anything else is sent to them."""
+    stage(conn, 'staged_ids', "id TEXT PRIMARY KEY", [(device_id,) for device_id in device_ids])
+    # Literal 'planned' so SQLite can use the partial index
+    rows = conn.execute('''
+        SELECT s.id FROM temp.staged_ids s JOIN sync_plan p INDEXED BY idx_sync_plan_device
+        ON p.status = 'planned' AND p.device_id = s.id AND p.action = ?
+    ''', (PLAN_CLEAR,))
+    return {row[0] for row in rows}
+
+def hold(conn, rows):
+    """Put operations taken for sending back in the plan untouched; they are skipped for the rest of the run."""
+    if not rows:
+        return
+    with conn:
+        # A row of the same operation planned meanwhile is the same message, so it is replaced rather than duplicated
+        conn.executemany("UPDATE OR REPLACE sync_plan SET status = ?, updated_at = ? WHERE id = ?",
+                         [(PLAN_PLANNED, datetime.now(timezone.utc).isoformat(), row[0]) for row in rows])
+    logging.warning(f"Holding back {len(rows)} operations for {len({row[2] for row in rows})} vehicles until their auth list is cleared")
+
+@instrumented('execute_plan')
+def execute_plan(conn, batcher):
+    """
+    Send every planned operation through the shared batcher, by priority and oldest first.
+
+    The plan is read in chunks of PLAN_CHUNK_SIZE, shared out between the priorities by next_chunk, so a
+    new driver's key is not stuck behind a large full load; each chunk is queued in one go so the batcher
+    can pack full multi_calls across devices and groups, and its results are written back in one transaction.
+    The next chunk is queued before the results of the one before are written, so the sends do not stop
+    for the database, and never more than one chunk ahead, so the sends cannot outrun the database either.
+    With ASYNC_IN_FLIGHT several multi_calls can be on their way at once and may arrive in any order, so
+    a chunk's clears are only sent once everything before them has been answered, and its other operations
+    only once the clears have: a vehicle's clear always reaches MyGeotab before its keys are added again.
+    A vehicle whose clear failed, or is still planned from an earlier chunk or run, gets nothing else until
+    the clear has gone out; its other operations stay planned for the next run.
+
+    Parameters:
+    conn (object): The database connection object.
+    batcher (MultiCallBatcher): The shared send queue.
+
+    Returns:
+    tuple: The number of operations sent and the number that failed.
+    """
+    sent = 0
+    failed = 0
+    started_at = datetime.now(timezone.utc).isoformat()
+    queued = None
+
+    def submit(rows):
+        return [(row, batcher.submit(['Add', {"typeName": 'TextMessage', "entity": plan_message(row[3], row[2], row[5])}])) for row in rows]
+
+    def write(queued):
+        nonlocal sent, failed
+        results = []
+        for (plan_id, group_id, device_id, action, serial_number, _, priority, planned_at), future in queued:
             try:
-                key = None
-                #Can't iterate over null and call fails with clearauthlist = true even with an empty array, needs specifically to be null
-                api.add("TextMessage", data)
-                logging.info(f"All Keys removed from vehicle with ID: {vehicle_to_update}")
+                results.append((plan_id, group_id, device_id, action, serial_number, future.result(), None))
+                sent += 1
+                if planned_at:
+                    metrics.latency(f"sent {priority}", (datetime.now(timezone.utc) - datetime.fromisoformat(planned_at)).total_seconds())
             except Exception as e:
-                logging.error(f"Unexpected error while clearing all keys from vehicle with ID: {vehicle_to_update}: {e}")
-                raise MyGeotabException({"errors": [{"name": "UnexpectedError", "message": str(e)}]})
-    except Exception as e:
-        logging.error(f"Unexpected error while processing keys for vehicle with ID: {vehicle_to_update}: {e}")
-        raise MyGeotabException({"errors": [{"name": "UnexpectedError", "message": str(e)}]})
-
-def search_failed(conn, group_id, column):
+                failed += 1
+                results.append((plan_id, group_id, device_id, action, serial_number, None, str(e)))
+                logging.error(f"Failed to {action} key {serial_number} on vehicle with ID: {device_id}: {e}")
+        record_plan_results(conn, results)
+
+    while True:
+        rows = next_chunk(conn, started_at)
+        futures = None
+        if rows:
+            with conn:
+                conn.executemany("UPDATE sync_plan SET status = ?, updated_at = ? WHERE id = ?",
+                                 [(PLAN_SENDING, datetime.now(timezone.utc).isoformat(), row[0]) for row in rows])
+            clears = [row for row in rows if row[3] == PLAN_CLEAR]
+            if clears and queued:
+                write(queued)
+                queued = None
+            futures = submit(clears)
+            wait([future for _, future in futures])
+            others = [row for row in rows if row[3] != PLAN_CLEAR]
+            held = uncleared_devices(conn, {row[2] for row in others}) | {row[2] for row, future in futures if future.exception()}
+            hold(conn, [row for row in others if row[2] in held])
+            futures += submit([row for row in others if row[2] not in held])
+        if queued:
+            write(queued)
+        if not rows:
+            break
+        queued = futures
+    logging.info(f"Executed sync plan: {sent} messages sent, {failed} failed")
+    return sent, failed
+
+def plan_summary(conn, group_names_by_id=None):
+    """Count the planned operations by group and action, for --dry-run and the run log."""
+    group_names_by_id = group_names_by_id or {}
+    rows = conn.execute('''
+        SELECT group_id, action, COUNT(*), COUNT(DISTINCT device_id) FROM sync_plan
+        WHERE status = 'planned' GROUP BY group_id, action ORDER BY group_id, action
+    ''').fetchall()
+    total = sum(row[2] for row in rows)
+    devices = conn.execute("SELECT COUNT(DISTINCT device_id) FROM sync_plan WHERE status = 'planned'").fetchone()[0]
+    lines = [f"Planned {total} messages to {devices} vehicles in about {-(-total // max(1, multicall_batch_size))} multi_calls"]
+    for action in (PLAN_CLEAR, PLAN_REMOVE, PLAN_ADD):
+        count = sum(row[2] for row in rows if row[1] == action)
+        lines.append(f"  {action}: {count}")
+    for group_id, action, count, device_count in rows:
+        lines.append(f"  {group_names_by_id.get(group_id, group_id)}: {count} {action} on {device_count} vehicles")
+    return "\n".join(lines)
+
+def mark_unsent(conn, device_id, keys):
+    """Record keys about to be planned for a vehicle as unsent, so its known list includes them from now on."""
+    updated_at = datetime.now(timezone.utc).isoformat()
+    conn.executemany('''
+        INSERT OR IGNORE INTO key_device_status (device_id, serial_number, state, updated_at) VALUES (?, ?, ?, ?)
+    ''', [(device_id, key['serialNumber'], KEY_STATE_UNSENT, updated_at) for key in keys])
+
+def remember_keys(conn, keys):
+    """Keep the key objects by serial number, so a key can still be removed once it is in no group."""
+    conn.executemany("INSERT OR REPLACE INTO driver_keys (serial_number, driver_key) VALUES (?, ?)",
+                     [(key['serialNumber'], json.dumps(key)) for key in keys])
+
+def stored_key(conn, serial_number):
+    row = conn.execute("SELECT driver_key FROM driver_keys WHERE serial_number = ?", (serial_number,)).fetchone()
+    return json.loads(row[0]) if row else {'serialNumber': serial_number}
+
+def known_keys(conn, device_id, serial_numbers=None):
+    """Serial numbers in a vehicle's last known list, all of them or only those among serial_numbers."""
+    if serial_numbers is None:
+        rows = conn.execute("SELECT serial_number FROM key_device_status WHERE device_id = ?", (device_id,))
+        return {row[0] for row in rows}
+    serial_numbers = list(serial_numbers)
+    known = set()
+    # Stay under SQLite's bound parameter limit
+    for start in range(0, len(serial_numbers), 500):
+        chunk = serial_numbers[start:start + 500]
+        rows = conn.execute(f'''
+            SELECT serial_number FROM key_device_status WHERE device_id = ? AND serial_number IN ({','.join('?' for _ in chunk)})
+        ''', [device_id] + chunk)
+        known |= {row[0] for row in rows}
+    return known
+
+def exception_key_holders(conn, serial_numbers):
+    """(device_id, serial_number) of every vehicle whose known list has one of the given keys, in one pass over key_device_status."""
+    stage(conn, 'staged_serials', "serialNumber TEXT PRIMARY KEY", [(serial_number,) for serial_number in serial_numbers])
+    rows = conn.execute('''
+        SELECT k.device_id, k.serial_number FROM key_device_status k JOIN temp.staged_serials s ON s.serialNumber = k.serial_number
+    ''')
+    return set(rows)
+
+@instrumented('plan_vehicles')
+def plan_vehicles(conn, run_id, groups, fetched, exception_keys=None):
     """
-    Search for keys in a specific group where a given column value is zero.
+    Work out every vehicle's authorization list across all of its groups and plan the difference.
+
+    A vehicle's desired list is the union of the keys of every synced group it is in plus the exception
+    keys, and its known list is its rows in key_device_status. Only the net difference between the
+    two is planned, so a vehicle in two groups is never sent a removal by one group for a key the other
+    group still has. Only vehicles that can have changed are looked at: those in a group whose keys
+    changed, those that joined or left a group and those with unsent keys. For a vehicle that stayed in
+    the same groups only the keys that changed are checked against its known list; one that joined or
+    left a group is compared in full. A vehicle no longer in any synced group is cleared. Each vehicle
+    gets either its individual changes or a clear and a full re-add, whichever is fewer messages.
+
+    Exception keys are stored once in keys_exceptions rather than copied into every group's table. When
+    they change, every vehicle is a candidate and which vehicles already hold the changed keys is read
+    in one query, so adding a mechanic is one pass over the fleet rather than one per group.
 
-    This function queries the database for keys in a specific group's table 
-    where the specified column has a value of zero. It returns a list of keys 
-    that match this criterion; this is to provide a more resiliant retry 
-    process for issues on a previous run.
+    The group tables, the status rows and the plan are committed in one transaction (see sync_plan).
 
     Parameters:
     conn (object): The database connection object.
-    group_id (str): The ID of the group whose keys are being searched.
-    column (str): The name of the column to be checked for a value of zero.
+    run_id (str): The id of this run in sync_plan.
+    groups (list): Every synced group.
+    fetched (dict): (all_keys, devices) for each group id fetched this run; other groups keep their stored keys and devices.
+    exception_keys (list): The exception group's keys, or None to keep the stored ones.
 
     Returns:
-    list: A list of dictionaries, each containing the following key data:
-        - driverKeyType (str): The type of the driver key.
-        - id (str): The ID of the key.
-        - keyId (str): The key ID.
-        - serialNumber (str): The serial number of the key.
+    int: The number of messages planned.
 
     Raises:
-    sqlite3.Error: Logs any SQLite errors encountered during the query process.
+    Exception: Any error rolls back the whole plan and is raised to the caller.
     """
-        
     try:
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute(f'''
-                SELECT driverKeyType, id, keyId, serialNumber
-                FROM keys_{group_id}
-                WHERE {column} = 0
-            ''')
-            results = cursor.fetchall()
-
-            keys = []
-            for row in results:
-                key_data = {
-                    'driverKeyType': row[0],
-                    'id': row[1],
-                    'keyId': row[2],
-                    'serialNumber': row[3]
-                }
-                keys.append(key_data)
-
-        logging.info(f"Found keys with {column} = 0 in keys_{group_id}: {keys}")
-        return keys
-    except sqlite3.Error as e:
-        logging.error(f"Error searching for {column} = 0 in keys_{group_id}: {e}")
-        return []
+        group_keys = {}
+        group_devices = {}
+        memberships = {}
+        key_changes = {}
+        moved = set()
+        left = {}
+        for group in groups:
+            group_id = group['id']
+            create_table(conn, f"keys_{group_id}", "driverKeyType TEXT, id TEXT, keyId TEXT, serialNumber TEXT PRIMARY KEY", "serialNumber")
+            create_table(conn, f"devices_{group_id}", "serialNumber TEXT PRIMARY KEY, deviceId TEXT", "serialNumber")
+            if group_id in fetched:
+                all_keys, devices = fetched[group_id]
+                new_keys = insert_keys(conn, group_id, all_keys)
+                removed_keys = remove_unused_keys(conn, group_id, all_keys)
+                new_devices = insert_devices(conn, group_id, devices)
+                removed_devices = remove_old_devices(conn, group_id, [device['serialNumber'] for device in devices])
+                remember_keys(conn, all_keys + removed_keys)
+                if new_keys or removed_keys:
+                    key_changes[group_id] = ({key['serialNumber'] for key in new_keys}, {key['serialNumber'] for key in removed_keys})
+                moved |= set(new_devices) | set(removed_devices)
+                for device_id in removed_devices:
+                    left.setdefault(device_id, group_id)
+                device_ids = {device['id'] for device in devices}
+            else:
+                rows = conn.execute(f"SELECT driverKeyType, id, keyId, serialNumber FROM keys_{group_id}").fetchall()
+                all_keys = [dict(zip(('driverKeyType', 'id', 'keyId', 'serialNumber'), row)) for row in rows]
+                device_ids = {row[0] for row in conn.execute(f"SELECT deviceId FROM devices_{group_id}")}
+            group_keys[group_id] = {key['serialNumber']: key for key in all_keys}
+            group_devices[group_id] = device_ids
+            for device_id in device_ids:
+                memberships.setdefault(device_id, set()).add(group_id)
+
+        create_table(conn, f"keys_{EXCEPTION_KEYS}", "driverKeyType TEXT, id TEXT, keyId TEXT, serialNumber TEXT PRIMARY KEY", "serialNumber")
+        if exception_keys is None:
+            rows = conn.execute(f"SELECT driverKeyType, id, keyId, serialNumber FROM keys_{EXCEPTION_KEYS}").fetchall()
+            exceptions = {row[3]: dict(zip(('driverKeyType', 'id', 'keyId', 'serialNumber'), row)) for row in rows}
+            exception_added = exception_dropped = set()
+        else:
+            exceptions = {key['serialNumber']: key for key in exception_keys}
+            exception_added = {key['serialNumber'] for key in insert_keys(conn, EXCEPTION_KEYS, list(exceptions.values()))}
+            removed_keys = remove_unused_keys(conn, EXCEPTION_KEYS, list(exceptions.values()))
+            exception_dropped = {key['serialNumber'] for key in removed_keys}
+            remember_keys(conn, list(exceptions.values()) + removed_keys)
+        exception_holders = exception_key_holders(conn, exception_added | exception_dropped)
+
+        unsent = {}
+        for device_id, serial_number in conn.execute("SELECT device_id, serial_number FROM key_device_status WHERE state = ?", (KEY_STATE_UNSENT,)):
+            unsent.setdefault(device_id, []).append(serial_number)
+        candidates = moved | set(left) | {device_id for device_id in unsent if device_id in memberships}
+        for group_id in key_changes:
+            candidates |= group_devices[group_id]
+        if exception_added or exception_dropped:
+            candidates |= set(memberships)
+
+        desired_lists = {}
+        planned = 0
+        rebuilt = 0
+        for device_id in sorted(candidates):
+            device_groups = memberships.get(device_id)
+            if not device_groups:
+                # Gone from every synced group: one clear instead of a removal per key
+                conn.execute("DELETE FROM key_device_status WHERE device_id = ?", (device_id,))
+                conn.execute("DELETE FROM sync_plan WHERE status = ? AND device_id = ? AND action IN (?, ?)", (PLAN_PLANNED, device_id, PLAN_ADD, PLAN_REMOVE))
+                planned += plan_operations(conn, run_id, left[device_id], device_id, PLAN_CLEAR, [], PRIORITY_REMOVE)
+                continue
+            record_group = min(device_groups)
+            list_id = frozenset(device_groups)
+            if list_id not in desired_lists:
+                desired = {}
+                for group_id in sorted(device_groups):
+                    for serial_number, key in group_keys[group_id].items():
+                        desired.setdefault(serial_number, key)
+                for serial_number, key in exceptions.items():
+                    desired.setdefault(serial_number, key)
+                desired_lists[list_id] = desired
+            desired = desired_lists[list_id]
+            if device_id in moved:
+                known = known_keys(conn, device_id)
+                adds = [key for serial_number, key in desired.items() if serial_number not in known]
+                removes = [serial_number for serial_number in known if serial_number not in desired]
+            else:
+                added = set()
+                dropped = set()
+                for group_id in device_groups & key_changes.keys():
+                    added |= key_changes[group_id][0]
+                    dropped |= key_changes[group_id][1]
+                known = known_keys(conn, device_id, added | dropped)
+                known |= {serial_number for serial_number in exception_added | exception_dropped if (device_id, serial_number) in exception_holders}
+                added |= exception_added
+                dropped = {serial_number for serial_number in dropped | exception_dropped if serial_number not in desired}
+                adds = [desired[serial_number] for serial_number in added if serial_number not in known]
+                removes = [serial_number for serial_number in dropped if serial_number in known]
+            retries = [desired[serial_number] for serial_number in unsent.get(device_id, []) if serial_number in desired]
+
+            incremental_cost = len(adds) + len(removes) + len(retries)
+            if allow_rebuild and 1 + len(desired) < incremental_cost:
+                logging.info(f"Rebuilding auth list of {device_id}: {1 + len(desired)} messages instead of {incremental_cost}")
+                planned += plan_rebuild(conn, run_id, record_group, device_id, list(desired.values()))
+                rebuilt += 1
+                continue
+            if removes:
+                conn.executemany("DELETE FROM key_device_status WHERE device_id = ? AND serial_number = ?",
+                                 [(device_id, serial_number) for serial_number in removes])
+                planned += plan_operations(conn, run_id, record_group, device_id, PLAN_REMOVE, [stored_key(conn, serial_number) for serial_number in removes], PRIORITY_REMOVE)
+            if adds:
+                mark_unsent(conn, device_id, adds)
+                # A vehicle new to a group gets its whole list, the others only the keys new since the last run
+                planned += plan_operations(conn, run_id, record_group, device_id, PLAN_ADD, adds, PRIORITY_FULL_LOAD if device_id in moved else PRIORITY_NEW_KEY)
+            if retries:
+                planned += plan_operations(conn, run_id, record_group, device_id, PLAN_ADD, retries, PRIORITY_RETRY)
+        planned -= collapse_plan(conn)
+        # Group table changes are committed together with the operations planned from them
+        conn.commit()
+        logging.info(f"Planned {planned} messages for {len(candidates)} vehicles, {rebuilt} rebuilt")
+        return planned
+    except Exception:
+        conn.rollback()
+        raise
+
+def fetch_group(credentials, group, batcher):
+    """
+    Worker: fetch a group's keys and devices and apply the user and device patches.
+
+    Each worker builds its own API object from the shared session credentials and opens its own
+    SQLite connection, so nothing is shared between threads. Nothing is planned here; plan_vehicles
+    compares every group at once, since a vehicle can be in more than one.
 
+    Parameters:
+    credentials (object): The authenticated MyGeotab credentials.
+    group (dict): A dictionary containing all of the group's information from geotab.
+    batcher (MultiCallBatcher): The shared send queue, used for user and device patches.
 
+    Returns:
+    tuple: The group's keys and its devices (dictionaries with 'id' and 'serialNumber').
 
-def search_texts(api, group_id):
+    Raises:
+    Exception: Any error is raised to the caller so it can be logged against the group.
+    """
+    api = RateLimitedAPI.from_credentials(credentials)
+    conn = create_connection(db_file)
+    metrics.group(group['name'])
     try:
-        texts = api.get('TextMessage', search={
-            "contentTypes": ["DriverAuthList"],
-            "latestMessageOnly": True,
-            "IsDelivered": False,
-            "deviceSearch": {
-                "groups": [{"id": group_id}]
+        all_keys = get_users_with_nfc_keys(api, group['id'], group['name'], conn, batcher)
+        devices = load_group_devices(api, group['id'], group['name'], conn, batcher=batcher)
+        return all_keys, devices
+    finally:
+        conn.close()
+
+def run_groups(worker, groups, credentials, *extra):
+    """
+    Run a worker for every group on a bounded thread pool.
+
+    A failure in one group is logged and does not stop the other groups. The pool size is set by
+    GROUP_CONCURRENCY in the .env file.
+
+    Parameters:
+    worker (callable): The function to run, called as worker(credentials, group, *extra).
+    groups (list): The groups to process.
+    credentials (object): The authenticated MyGeotab credentials.
+    extra: Any extra arguments for the worker.
+
+    Returns:
+    dict: The worker's return value for each group id that completed.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, group_concurrency)) as executor:
+        futures = {executor.submit(worker, credentials, group, *extra): group for group in groups}
+        for future in as_completed(futures):
+            group = futures[future]
+            try:
+                results[group['id']] = future.result()
+            except Exception as e:
+                metrics.error()
+                logging.error(f"Error processing group {group['name']} ({group['id']}): {e}")
+    return results
+
+
+###Daemon mode ##################################################################################################################################################
+# Instead of a fresh process from cron for every run, --daemon keeps one MyGeotab session (renewed only when it expires), one
+# database connection and the shared send queue for its whole life, and syncs each group on its own interval. User and Device
+# come from the GetFeed cache, so a sync only downloads what changed since the last one and can run every few minutes.
+class DaemonStatus:
+    """What the daemon is doing, for the /health and /status endpoints."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time()
+        self.heartbeat = time()
+        self.cycles = 0
+        self.last_cycle = None
+        self.last_error = None
+        self.groups = {}
+
+    def beat(self):
+        with self.lock:
+            self.heartbeat = time()
+
+    def cycle(self, seconds, error=None):
+        with self.lock:
+            self.cycles += 1
+            self.last_cycle = {'finished': datetime.now(timezone.utc).isoformat(), 'seconds': round(seconds, 3), 'error': error}
+            self.last_error = error
+
+    def group(self, name, ok, next_due):
+        with self.lock:
+            entry = self.groups.setdefault(name, {'syncs': 0, 'failures': 0})
+            entry['syncs'] += 1
+            entry['failures'] += 0 if ok else 1
+            entry['last_sync'] = datetime.now(timezone.utc).isoformat()
+            entry['last_ok'] = ok
+            entry['next_sync'] = datetime.fromtimestamp(next_due, timezone.utc).isoformat()
+
+    def healthy(self):
+        # The loop wakes at least once a minute, so a stale heartbeat means it is stuck
+        with self.lock:
+            return time() - self.heartbeat < 180 and self.last_error is None
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'healthy': time() - self.heartbeat < 180 and self.last_error is None,
+                'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                'cycles': self.cycles,
+                'last_cycle': self.last_cycle,
+                'groups': copy.deepcopy(self.groups),
+                'rate_limiter': rate_limiter.summary(),
             }
-        })
 
-#To do
-#Either pipe output straight into calls or just edit database and do it on next run
-    
+class GroupScheduler:
+    """Next due time of every group, from GROUP_INTERVALS or DAEMON_INTERVAL."""
+
+    def __init__(self):
+        self.next_due = {}
+
+    def interval(self, group):
+        return group_intervals.get(group['name'], daemon_interval)
+
+    def due(self, groups, now):
+        return [group for group in groups if self.next_due.get(group['id'], 0) <= now]
+
+    def done(self, group, now):
+        self.next_due[group['id']] = now + self.interval(group)
+        return self.next_due[group['id']]
+
+    def wait(self, groups, now):
+        if not groups:
+            return daemon_interval
+        return max(0, min(self.next_due.get(group['id'], 0) for group in groups) - now)
+
+def status_server(status, port):
+    """Serve /health, /status (JSON) and /metrics (Prometheus text) for the daemon on localhost."""
+
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/health':
+                healthy = status.healthy()
+                self.reply(200 if healthy else 503, 'text/plain', 'ok\n' if healthy else 'unhealthy\n')
+            elif self.path == '/status':
+                self.reply(200, 'application/json', json.dumps(status.snapshot(), indent=2))
+            elif self.path == '/metrics':
+                self.reply(200, 'text/plain; version=0.0.4', metrics.prometheus())
+            else:
+                self.reply(404, 'text/plain', 'not found\n')
+
+        def reply(self, code, content_type, body):
+            body = body.encode()
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(f"Status endpoint: {format % args}")
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), StatusHandler)
+    threading.Thread(target=server.serve_forever, name='status-server', daemon=True).start()
+    logging.info(f"Status endpoint listening on http://127.0.0.1:{port}")
+    return server
+
+def sync_due_groups(api, conn, batcher, all_groups, groups, scheduler, status):
+    """
+    One daemon cycle: plan and send the groups that are due and schedule their next sync.
+
+    Parameters:
+    api (object): The daemon's API object.
+    conn (object): The daemon's database connection.
+    batcher (MultiCallBatcher): The shared send queue.
+    all_groups (list): Every synced group; vehicles are planned across all of them.
+    groups (list): The groups that are due.
+    scheduler (GroupScheduler): The daemon's schedule.
+    status (DaemonStatus): The daemon's status, updated for the endpoint.
+
+    Returns:
+    None
+    """
+    metrics.reset()
+    started = perf_counter()
+    error = None
+    planned = set()
+    try:
+        planned = plan_groups(api, conn, session_credentials, batcher, all_groups, groups)
+        logging.info(plan_summary(conn, {group['id']: group['name'] for group in groups}))
+        execute_plan(conn, batcher)
     except Exception as e:
-        logging.error(f"Error in main process: {e}")
+        metrics.error()
+        error = str(e)
+        logging.error(f"Error in daemon cycle: {e}")
+    finally:
+        now = monotonic()
+        for group in groups:
+            next_due = scheduler.done(group, now)
+            status.group(group['name'], group['id'] in planned and error is None, time() + next_due - now)
+        status.cycle(perf_counter() - started, error)
+        write_metrics()
+
+def run_daemon():
+    """
+    Run as a long-lived service until SIGTERM or SIGINT, syncing every group on its interval.
 
-        
-def process_group(api, group, conn, exception_keys):
+    Parameters:
+    None
+
+    Returns:
+    None
     """
-    Process a group to fetch NFC keys and update vehicle information.
+    global incremental_sync
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stop.set())
+    if not incremental_sync:
+        # Without the feed cache every cycle would download the whole fleet again
+        logging.info("Daemon mode uses the GetFeed cache; INCREMENTAL_SYNC turned on.")
+        incremental_sync = True
+    status = DaemonStatus()
+    scheduler = GroupScheduler()
+    api, conn, credentials = authenticate(db_file)
+    create_plan_table(conn)
+    batcher = create_batcher(RateLimitedAPI.from_credentials(credentials))
+    server = status_server(status, status_port) if status_port else None
+    groups = []
+    groups_loaded = None
+    logging.info("Daemon started.")
+    try:
+        while not stop.is_set():
+            status.beat()
+            try:
+                if groups_loaded is None or monotonic() - groups_loaded >= group_refresh_interval:
+                    all_groups = api.get('Group', search=dict(active=True))
+                    load_group_tree(all_groups)
+                    groups = [group for group in all_groups if group['name'] in group_names]
+                    groups_loaded = monotonic()
+                due = scheduler.due(groups, monotonic())
+                if due:
+                    sync_due_groups(api, conn, batcher, groups, due, scheduler, status)
+            except Exception as e:
+                metrics.error()
+                status.cycle(0, str(e))
+                logging.error(f"Error in daemon loop: {e}")
+                # Don't spin on a persistent failure such as the server being down
+                stop.wait(min(60, daemon_interval))
+                continue
+            stop.wait(min(60, max(1, scheduler.wait(groups, monotonic()))))
+    finally:
+        batcher.close()
+        if server:
+            server.shutdown()
+        conn.close()
+        logging.info(f"Daemon stopped. Rate limiter: {rate_limiter.summary()}")
+
+####Main Process
+def copy_database(source, destination):
+    """Copy an SQLite database with the backup API, so a dry run can plan against a throwaway copy."""
+    source_conn = sqlite3.connect(source)
+    destination_conn = sqlite3.connect(destination)
+    try:
+        source_conn.backup(destination_conn)
+    finally:
+        source_conn.close()
+        destination_conn.close()
 
-    This function processes a specified group by fetching users with NFC keys, updating the vehicle
-    authorization lists, and managing database records. It integrates functionalities to handle
-    new and removed keys, as well as to update vehicle data.
+def plan_groups(api, conn, credentials, batcher, groups, due_groups=None):
+    """
+    Bring the local caches up to date and plan every change for the given groups into sync_plan.
 
     Parameters:
-    api (object): The API object used to fetch and update data.
-    group (dict): A dictionary containing all of the group's information from geotab.
+    api (object): The API object for the run's own calls.
     conn (object): The database connection object.
-    exception_keys (list): A list of exception keys to be added to all groups.
+    credentials (object): The authenticated MyGeotab credentials, for the group workers.
+    batcher (MultiCallBatcher): The shared send queue, used for entity patches.
+    groups (list): Every synced group.
+    due_groups (list): The groups to fetch again; the others keep their stored keys and devices. Default all.
 
     Returns:
-    tuple: A tuple containing the following elements:
-        - new_keys (list): List of new keys inserted into the database for a given group.
-        - remove_keys (list): List of keys removed from the database for a given group.
-        - all_keys (list): List of all processed keys in a given group.
-        - group_id (str): The ID of the processed group.
-        - group_name (str): The name of the processed group.
-        - filtered_devices (list): List of devices after processing.
-        - new_devices (list): List of new devices inserted into the database.
+    set: The ids of the groups that were fetched and planned without errors.
+    """
+    global fleet_snapshot
+    run_id = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+    prune_plan(conn)
+    if incremental_sync:
+        sync_feed(api, conn, 'User', full=full_resync)
+        sync_feed(api, conn, 'Device', full=full_resync)
+    elif use_fleet_snapshot:
+        fleet_snapshot = FleetSnapshot.fetch(api)
+    reconcile_in_doubt(api, conn)
+    exception_keys = get_exception_users(api, exception_group_id, conn)
+    fetched = run_groups(fetch_group, groups if due_groups is None else due_groups, credentials, batcher)
+    # A group that failed to fetch keeps its stored state, so its vehicles are not stripped of its keys
+    plan_vehicles(conn, run_id, groups, fetched, exception_keys)
+    return set(fetched)
+
+def main(dry_run_only=False, execute_only=False):
+    """
+    Run a sync: plan every group's changes into sync_plan, then execute the plan.
 
-    Returns empty lists if the database connection is not provided.
+    Parameters:
+    dry_run_only (bool): Plan against a temporary copy of authlist.db, print the plan statistics and
+    make no API writes. The real database is left untouched.
+    execute_only (bool): Skip planning and only send what is already planned, e.g. after a failed run.
 
-    Raises:
+    Returns:
     None
-    """   
-    if conn:
-        group_id = group['id']
-        group_name = group['name']
-        new_keys, remove_keys, all_keys = get_users_with_nfc_keys(api, group_id, group_name, conn, exception_keys)
-        filtered_devices, new_devices = get_vans_by_group(api, group_id, group_name, conn, add=True)
-        return new_keys, remove_keys, all_keys, group_id, group_name, filtered_devices, new_devices
-    return [], [], [], [], [], []
-
-####Main Process
-def main():
+    """
+    global db_file, dry_run
+    conn = None
+    metrics.reset()
+    real_db_file = db_file
+    dry_run_dir = None
     try:
+        if dry_run_only:
+            dry_run_dir = tempfile.mkdtemp(prefix='authlist-dry-run-')
+            db_file = os.path.join(dry_run_dir, os.path.basename(real_db_file))
+            if os.path.exists(real_db_file):
+                copy_database(real_db_file, db_file)
+            dry_run = True
         api, conn, credentials = authenticate(db_file)
-        groups = api.get('Group', search=dict(active=True))
-        filtered_groups = [group for group in groups if group['name'] in group_names]
-        for group in filtered_groups:
-            group_id = group['id']
-            group_name = group['name']
-            removed_devices = get_vans_by_group(api, group_id, group_name,conn,add=False)
-            logging.debug(f"Removed devices: {removed_devices}")
-
-## Need to add a break here to clear old devices before continuting           
-            for device in removed_devices:
-                if removed_devices:
-                    null_key = []
-                    send_text_message(api, device, null_key, all_keys, group_id, add=False,clear=True,Time=0, retries=3, delay=5)
-            del(removed_devices)
-
-## Need to add a break here to clear old devices before continuting           
-        exception_keys = get_exception_users(api, exception_group_id)
-        
-        for group in filtered_groups:
-            new_keys, remove_keys, all_keys, group_id, group_name, filtered_devices, new_devices = process_group(api, group, conn, exception_keys)        
-            
-            for device in filtered_devices:
-                """
-Logic:
-- If the device is new, add all keys to its whitelist.
-- If the device is not new:
-  - Remove any keys that need to be removed.
-  - Add any new keys that need to be added.
-  - Search for any keys that failed to update previously and retry adding them.
-"""             
-                vehicle_to_update = device['id']
-                logging.info(f"Processing Device {vehicle_to_update} in group {group_name}")
-                
-                if device['id'] in new_devices:
-                    logging.info(f"New device ID: {vehicle_to_update} found. Adding all keys to whitelist.")
-                    send_text_message(api, vehicle_to_update, all_keys, group_id, conn, add=True,clear=False,Time=0.01,retries=3, delay=9)
-                else:
-                    if remove_keys:
-                        send_text_message(api, vehicle_to_update, remove_keys, group_id, conn, add=False,clear=False,Time=0.00,retries=3, delay=6)
-                    if new_keys:
-                        send_text_message(api, vehicle_to_update, new_keys, group_id, conn, add=True,clear=False,Time=0.00,retries=3, delay=6)
-                    retry_keys = search_failed(conn, group_id, vehicle_to_update)
-                    if retry_keys:
-                        send_text_message(api, vehicle_to_update, retry_keys,  group_id, conn, add=True,clear=False,Time=0.01,retries=3, delay=9)
-
+        create_plan_table(conn)
+        batcher = create_batcher(RateLimitedAPI.from_credentials(credentials))
+        try:
+            if not execute_only:
+                groups = api.get('Group', search=dict(active=True))
+                load_group_tree(groups)
+                filtered_groups = [group for group in groups if group['name'] in group_names]
+                plan_groups(api, conn, credentials, batcher, filtered_groups)
+                summary = plan_summary(conn, {group['id']: group['name'] for group in filtered_groups})
+                logging.info(summary)
+                if dry_run:
+                    print(summary)
+            else:
+                reconcile_in_doubt(api, conn)
+            if not dry_run:
+                execute_plan(conn, batcher)
+        finally:
+            batcher.close()
+            logging.info(f"Rate limiter: {rate_limiter.summary()}")
         
         conn.close()
   
     except Exception as e:
+        metrics.error()
         logging.error(f"Error in main process: {e}")
-        conn.close()
+        if conn:
+            conn.close()
+    finally:
+        if dry_run_dir:
+            shutil.rmtree(dry_run_dir, ignore_errors=True)
+            db_file = real_db_file
+            dry_run = False
+    write_metrics()
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Sync MyGeotab driver keys to vehicle authorization lists.")
+    parser.add_argument('--dry-run', action='store_true', help="print what would be sent without making any API writes")
+    parser.add_argument('--execute-only', action='store_true', help="only send what is already planned, without fetching or diffing")
+    parser.add_argument('--daemon', action='store_true', help="keep running and sync each group on its interval")
+    args = parser.parse_args()
+    if args.daemon:
+        run_daemon()
+    else:
+        main(dry_run_only=args.dry_run, execute_only=args.execute_only)
@@ -1,41 +1,245 @@
-username = os.getenv('GEOTAB_USERNAME')
-password = os.getenv('GEOTAB_PASSWORD')
-database = os.getenv('GEOTAB_DATABASE')
-group_names = os.getenv('GEOTAB_GROUPS', '').split(',')
-db_file = 'authlist.db'
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-
-api = API(username, password, database)
-def search_texts_authlistcontent(api):
+import os
+import json
+import logging
+import argparse
+from datetime import datetime, timezone, timedelta
+
+# Shares main.py's session, settings and database setup
+from main import (
+    EXCEPTION_KEYS, PLAN_ADD, PLAN_CLEAR, authenticate, db_file, feed_results_limit, group_names, is_delivered, plan_action,
+)
+
+# The DriverAuthList history is kept next to authlist.db; 0 downloads all of it on the first run
+audit_db_file = os.getenv('AUDIT_DB_FILE', 'authlist_audit.db')
+audit_lookback_days = float(os.getenv('AUDIT_LOOKBACK_DAYS', 0))
+
+def create_audit_tables(conn):
+    """Attach the audit database and create its message history, indexed for replaying one vehicle at a time."""
+    conn.execute("ATTACH DATABASE ? AS audit", (audit_db_file,))
+    conn.execute("PRAGMA audit.journal_mode=WAL")
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS audit.auth_messages (
+                id TEXT PRIMARY KEY,
+                device_id TEXT NOT NULL,
+                sent TEXT NOT NULL,
+                delivered TEXT,
+                action TEXT NOT NULL,
+                serial_number TEXT
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS audit.idx_auth_messages_device ON auth_messages (device_id, serial_number, sent)")
+        conn.execute("CREATE TABLE IF NOT EXISTS audit.feed_versions (type_name TEXT PRIMARY KEY, to_version TEXT, updated_at TEXT)")
+
+def sync_history(api, conn):
+    """
+    Add the DriverAuthList messages sent or delivered since the last audit to the local history.
+
+    Messages are read with GetFeed from the version the last audit stopped at, so after the first run only
+    new messages and delivery updates are downloaded. A message seen again (usually because it was delivered)
+    replaces its row. Each page is stored with the new version in one transaction, so an interrupted
+    download picks up where it stopped.
+
+    Parameters:
+    api (object): The API object used to call GetFeed.
+    conn (object): The database connection, with the audit database attached.
+
+    Returns:
+    int: The number of DriverAuthList messages stored.
+    """
+    row = conn.execute("SELECT to_version FROM audit.feed_versions WHERE type_name = 'TextMessage'").fetchone()
+    parameters = dict(type_name='TextMessage', from_version=row[0] if row else None, results_limit=feed_results_limit)
+    if row is None and audit_lookback_days:
+        parameters['search'] = {'fromDate': datetime.now(timezone.utc) - timedelta(days=audit_lookback_days)}
+    stored = 0
+    while True:
+        result = api.call('GetFeed', **parameters)
+        texts = result.get('data', [])
+        parameters['from_version'] = result.get('toVersion')
+        parameters.pop('search', None)
+        messages = []
+        for text in texts:
+            content = text.get('messageContent') or {}
+            if content.get('contentType') != "DriverAuthList":
+                continue
+            action = plan_action(content)
+            serial_number = None if action == PLAN_CLEAR else (content.get('driverKey') or {}).get('serialNumber')
+            delivered = text['delivered'].isoformat() if is_delivered(text) else None
+            messages.append((text['id'], text['device']['id'], text['sent'].isoformat(), delivered, action, serial_number))
+        with conn:
+            conn.executemany('''
+                INSERT INTO audit.auth_messages (id, device_id, sent, delivered, action, serial_number) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET delivered = excluded.delivered
+            ''', messages)
+            conn.execute('''
+                INSERT OR REPLACE INTO audit.feed_versions (type_name, to_version, updated_at) VALUES (?, ?, ?)
+            ''', ('TextMessage', parameters['from_version'], datetime.now(timezone.utc).isoformat()))
+        stored += len(messages)
+        if len(texts) < feed_results_limit:
+            break
+    logging.info(f"Audit history: {stored} DriverAuthList messages added or updated")
+    return stored
+
+def replay(conn, table_name, delivered_only):
+    """
+    Rebuild every vehicle's auth list from its message history into a temporary table.
+
+    A key is on a vehicle when its latest add or remove after the vehicle's latest clear is an add.
+    Messages are ordered by the time they were sent, ties by the order they were first stored.
+
+    Parameters:
+    conn (object): The database connection, with the audit database attached.
+    table_name (str): The temporary table for the (device_id, serial_number) rows.
+    delivered_only (bool): Replay only delivered messages, i.e. what the vehicles have now, instead of
+    everything sent, i.e. what they will have once every message is delivered.
+
+    Returns:
+    None
+    """
+    delivered = "AND m.delivered IS NOT NULL" if delivered_only else ""
+    conn.execute(f"DROP TABLE IF EXISTS temp.{table_name}")
+    conn.execute(f'''
+        CREATE TEMP TABLE {table_name} AS
+        WITH clears AS (
+            SELECT m.device_id, m.sent, m.rowid AS seq,
+                   ROW_NUMBER() OVER (PARTITION BY m.device_id ORDER BY m.sent DESC, m.rowid DESC) AS n
+            FROM audit.auth_messages m WHERE m.action = '{PLAN_CLEAR}' {delivered}
+        ),
+        latest AS (
+            SELECT m.device_id, m.serial_number, m.action,
+                   ROW_NUMBER() OVER (PARTITION BY m.device_id, m.serial_number ORDER BY m.sent DESC, m.rowid DESC) AS n
+            FROM audit.auth_messages m LEFT JOIN clears c ON c.device_id = m.device_id AND c.n = 1
+            WHERE m.action != '{PLAN_CLEAR}' {delivered}
+              AND (c.device_id IS NULL OR (m.sent, m.rowid) > (c.sent, c.seq))
+        )
+        SELECT device_id, serial_number FROM latest WHERE n = 1 AND action = '{PLAN_ADD}'
+    ''')
+    conn.execute(f"CREATE UNIQUE INDEX temp.idx_{table_name} ON {table_name} (device_id, serial_number)")
+
+def load_expected(conn, group_ids):
+    """
+    Load from authlist.db what every synced vehicle should have, the way plan_vehicles works it out.
+
+    A vehicle should have the keys of every synced group it is in plus the exception keys. Only the group
+    memberships and each group's keys are loaded, into temp.audit_fleet (group_id, device_id) and
+    temp.audit_group_keys (group_id, serial_number), with the exception keys under EXCEPTION_KEYS;
+    expected_keys() puts a vehicle's list together from them when it is needed.
+    """
+    tables = {row[0] for row in conn.execute("SELECT name FROM main.sqlite_master WHERE type = 'table'")}
+    for table_name, schema in (('audit_fleet', "group_id TEXT, device_id TEXT, PRIMARY KEY (group_id, device_id)"),
+                               ('audit_group_keys', "group_id TEXT, serial_number TEXT, PRIMARY KEY (group_id, serial_number)")):
+        conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table_name} ({schema})")
+        conn.execute(f"DELETE FROM temp.{table_name}")
+    conn.execute("CREATE INDEX IF NOT EXISTS temp.idx_audit_fleet_device ON audit_fleet (device_id)")
+    for group_id in group_ids:
+        if f"devices_{group_id}" not in tables or f"keys_{group_id}" not in tables:
+            continue
+        conn.execute(f"INSERT OR IGNORE INTO temp.audit_fleet SELECT ?, deviceId FROM devices_{group_id}", (group_id,))
+        conn.execute(f"INSERT OR IGNORE INTO temp.audit_group_keys SELECT ?, serialNumber FROM keys_{group_id}", (group_id,))
+    if f"keys_{EXCEPTION_KEYS}" in tables:
+        conn.execute(f"INSERT OR IGNORE INTO temp.audit_group_keys SELECT ?, serialNumber FROM keys_{EXCEPTION_KEYS}", (EXCEPTION_KEYS,))
+
+def expected_keys(device):
+    """SQL for the serial numbers the vehicle `device` (a column or a parameter) should have, after load_expected."""
+    return f'''
+        SELECT k.serial_number FROM temp.audit_group_keys k
+        WHERE k.group_id = '{EXCEPTION_KEYS}' OR k.group_id IN (SELECT g.group_id FROM temp.audit_fleet g WHERE g.device_id = {device})
+    '''
+
+def drift_report(conn, group_ids_by_name):
+    """
+    Compare every synced vehicle's replayed auth list with what authlist.db says it should have.
+
+    A vehicle is in sync when its delivered messages give exactly the expected keys, waiting when that
+    only happens once its undelivered messages arrive, and drifted when even all of its messages do not
+    add up to the expected keys. Missing keys are expected keys no message will bring, extra keys are keys
+    it will keep that it should not have. Each vehicle is compared against its groups' key sets, so the
+    vehicles x keys list of what every vehicle should have is never written out.
+
+    Parameters:
+    conn (object): The database connection, with the audit database attached.
+    group_ids_by_name (dict): The synced groups.
+
+    Returns:
+    list: One dict per group with its vehicle and key counts.
+    """
+    load_expected(conn, group_ids_by_name.values())
+    replay(conn, 'audit_installed', delivered_only=True)
+    replay(conn, 'audit_sent', delivered_only=False)
+    conn.execute("DROP TABLE IF EXISTS temp.audit_vehicles")
+    conn.execute(f'''
+        CREATE TEMP TABLE audit_vehicles AS
+        SELECT f.device_id,
+            (SELECT COUNT(*) FROM ({expected_keys('f.device_id')} EXCEPT
+                SELECT s.serial_number FROM temp.audit_sent s WHERE s.device_id = f.device_id)) AS missing,
+            (SELECT COUNT(*) FROM (SELECT s.serial_number FROM temp.audit_sent s WHERE s.device_id = f.device_id EXCEPT
+                {expected_keys('f.device_id')})) AS extra,
+            (SELECT COUNT(*) FROM temp.audit_sent s WHERE s.device_id = f.device_id AND NOT EXISTS (
+                SELECT 1 FROM temp.audit_installed i WHERE i.device_id = s.device_id AND i.serial_number = s.serial_number))
+            + (SELECT COUNT(*) FROM temp.audit_installed i WHERE i.device_id = f.device_id AND NOT EXISTS (
+                SELECT 1 FROM temp.audit_sent s WHERE s.device_id = i.device_id AND s.serial_number = i.serial_number)) AS waiting
+        FROM (SELECT DISTINCT device_id FROM temp.audit_fleet) f
+    ''')
+    names_by_id = {group_id: name for name, group_id in group_ids_by_name.items()}
+    rows = conn.execute('''
+        SELECT f.group_id, COUNT(*),
+            SUM(v.missing = 0 AND v.extra = 0 AND v.waiting = 0),
+            SUM(v.missing = 0 AND v.extra = 0 AND v.waiting > 0),
+            SUM(v.missing > 0 OR v.extra > 0),
+            SUM(v.missing), SUM(v.extra)
+        FROM temp.audit_fleet f JOIN temp.audit_vehicles v ON v.device_id = f.device_id
+        GROUP BY f.group_id
+    ''').fetchall()
+    fields = ('vehicles', 'in_sync', 'waiting', 'drifted', 'missing_keys', 'extra_keys')
+    return sorted(({'group': names_by_id.get(row[0], row[0]), **dict(zip(fields, row[1:]))} for row in rows), key=lambda entry: entry['group'])
+
+def vehicle_detail(conn, device_id):
+    """The expected, delivered and sent keys of one vehicle after drift_report, as sorted serial numbers."""
+    detail = {'expected': sorted({row[0] for row in conn.execute(expected_keys('?'), (device_id,))})}
+    for table_name in ('installed', 'sent'):
+        detail[table_name] = sorted(row[0] for row in conn.execute(f"SELECT serial_number FROM temp.audit_{table_name} WHERE device_id = ?", (device_id,)))
+    return detail
+
+def print_report(report):
+    print(f"{'group':<30}{'vehicles':>10}{'in sync':>10}{'waiting':>10}{'drifted':>10}{'missing':>10}{'extra':>10}")
+    for entry in report:
+        print(f"{entry['group']:<30}{entry['vehicles']:>10}{entry['in_sync']:>10}{entry['waiting']:>10}"
+              f"{entry['drifted']:>10}{entry['missing_keys']:>10}{entry['extra_keys']:>10}")
+
+def main(devices=None, json_path=None):
+    """
+    Audit the synced vehicles: update the message history, replay it and report the drift per group.
+
+    Parameters:
+    devices (list): Vehicle ids to print the expected, delivered and sent keys of.
+    json_path (str): Also write the report to this file.
+
+    Returns:
+    list: The per group report, see drift_report.
+    """
+    api, conn, credentials = authenticate(db_file)
     try:
-        now_utc = datetime.now(timezone.utc) - timedelta(days=1)
-        logging.info(f"time {now_utc}")
-        texts = api.get('TextMessage', search={"fromDate": now_utc}) # Can't seem to combine search with messagecontent or device id
-        driver_auth_texts = [text for text in texts if text.get('messageContent', {}).get('contentType') == "DriverAuthList"] # to do find message delivery faliure and add.
-        #Filter to last unique message sent to prevent spam
-
-#        logging.info(f"Users: {json.dumps(driver_auth_texts, default=str)}")
-        logging.info(f"Keys {Keys}")
-            for key in Keys:
-                 logging.info(f"Key {key}")
-                 data = {
-
-    "device": {
-        "id": "b1B5"
-    },
-    "isDirectionToVehicle": True,
-    "messageContent": {
-        "driverKey": key,
-        "contentType": "DriverAuthList",
-        "clearAuthList": False,
-        "addToAuthList": True
-    }
-}
-
-                 api.add("TextMessage",data)
-                 action = "added to" if add else "removed from"
-                 logging.info(f"Keys {action} vehicle with ID: {vehicles_to_update}")
-         except Exception as e:
-             logging.error(f"Error sending text message to vehicle with ID: {vehicles_to_update}: {e}")
-#For loop over vehicle id's
-#Maybe check after like an hour if the vehicle should be driving? (recieving messages)
+        create_audit_tables(conn)
+        groups = api.get('Group', search=dict(active=True))
+        group_ids_by_name = {group['name']: group['id'] for group in groups if group['name'] in group_names}
+        sync_history(api, conn)
+        report = drift_report(conn, group_ids_by_name)
+        for entry in report:
+            logging.info(f"Audit {entry['group']}: {entry['vehicles']} vehicles, {entry['in_sync']} in sync, {entry['waiting']} waiting on delivery, "
+                         f"{entry['drifted']} drifted ({entry['missing_keys']} keys missing, {entry['extra_keys']} extra)")
+        print_report(report)
+        for device_id in devices or []:
+            print(f"\n{device_id}: {json.dumps(vehicle_detail(conn, device_id))}")
+        if json_path:
+            with open(json_path, 'w') as output:
+                json.dump(report, output, indent=2)
+        return report
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check every synced vehicle's auth list against authlist.db by replaying its DriverAuthList messages.")
+    parser.add_argument('--device', action='append', default=[], help="also list this vehicle's expected, delivered and sent keys, repeatable")
+    parser.add_argument('--json', help="also write the report to this file")
+    args = parser.parse_args()
+    main(args.device, args.json)
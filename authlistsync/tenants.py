@@ -0,0 +1,150 @@
+"""
+Sync several MyGeotab databases from one process.
+
+    python3 tenants.py
+    python3 tenants.py --tenant acme --dry-run
+
+TENANTS_FILE (tenants.json) lists the databases as a JSON list, one object per tenant with a "name"
+and any of main.py's settings under their .env names, e.g.
+
+    [{"name": "acme", "GEOTAB_USERNAME": "sync@acme.com", "GEOTAB_PASSWORD": "...", "GEOTAB_DATABASE": "acme",
+      "GEOTAB_GROUPS": "Depot A,Depot B", "EXCEPTION_GROUP_ID": "b27A4", "RATE_LIMITS": "ExecuteMultiCall=150"}]
+
+Settings a tenant leaves out come from .env. Every tenant gets its own copy of main.py, loaded with
+its settings, so its session, rate budgets, database file (DB_FILE, authlist_<name>.db by default),
+metrics file and caches are its own and nothing is shared with the other tenants. The tenants run
+at the same time, each on its own thread, so a slow or failing database holds up no one else.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from dotenv import load_dotenv
+
+load_dotenv()
+# The same log as main.py; each tenant's lines are prefixed with its name
+logging.basicConfig(
+    filename='authlistlog.txt',
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+tenants_file = os.getenv('TENANTS_FILE', 'tenants.json')
+# Tenants synced at the same time; by default all of them
+tenant_concurrency = int(os.getenv('TENANT_CONCURRENCY', 0))
+
+main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+required_settings = ('GEOTAB_USERNAME', 'GEOTAB_PASSWORD', 'GEOTAB_DATABASE', 'GEOTAB_GROUPS')
+# main.py reads its settings from the environment while it loads, so copies are loaded one at a time
+load_lock = threading.Lock()
+
+class TenantLog(logging.LoggerAdapter):
+    """Prefixes everything a tenant's copy of main.py logs with the tenant name."""
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['tenant']}] {msg}", kwargs
+
+def read_tenants(path):
+    """
+    Read and check the tenant list.
+
+    Parameters:
+    path (str): The JSON tenant file.
+
+    Returns:
+    list: One dict of settings per tenant, with DB_FILE and METRICS_FILE filled in when left out.
+
+    Raises:
+    ValueError: A tenant has no name or lacks a credential or GEOTAB_GROUPS, or two tenants share a name or database file.
+    """
+    with open(path) as tenant_file:
+        tenants = json.load(tenant_file)
+    names = set()
+    db_files = set()
+    for tenant in tenants:
+        name = tenant.get('name')
+        if not name:
+            raise ValueError(f"Every tenant in {path} needs a name")
+        missing = [setting for setting in required_settings if not tenant.get(setting)]
+        if missing:
+            raise ValueError(f"Tenant {name} is missing {', '.join(missing)}")
+        tenant.setdefault('DB_FILE', f"authlist_{name}.db")
+        tenant.setdefault('METRICS_FILE', f"authlist_metrics_{name}.json")
+        if name in names or tenant['DB_FILE'] in db_files:
+            raise ValueError(f"Tenant {name} repeats the name or DB_FILE of another tenant")
+        names.add(name)
+        db_files.add(tenant['DB_FILE'])
+    return tenants
+
+def load_tenant(tenant):
+    """
+    Load a private copy of main.py with the tenant's settings in the environment.
+
+    Parameters:
+    tenant (dict): The tenant's name and settings.
+
+    Returns:
+    module: The tenant's main.py; its main() syncs that tenant only.
+    """
+    settings = {key: str(value) for key, value in tenant.items() if key != 'name'}
+    with load_lock:
+        saved = dict(os.environ)
+        try:
+            os.environ.update(settings)
+            spec = importlib.util.spec_from_file_location(f"main_{tenant['name']}", main_path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+    module.logging = TenantLog(logging.getLogger(), {'tenant': tenant['name']})
+    return module
+
+def sync_tenant(name, module, dry_run_only=False, execute_only=False):
+    """Worker: run one tenant's sync. Returns its wall time and the errors it logged."""
+    threading.current_thread().name = f"tenant-{name}"
+    started = perf_counter()
+    module.main(dry_run_only=dry_run_only, execute_only=execute_only)
+    seconds = perf_counter() - started
+    module.logging.info(f"Tenant sync finished in {seconds:.1f}s with {module.metrics.errors} errors")
+    return seconds, module.metrics.errors
+
+def main(selected=None, dry_run_only=False, execute_only=False):
+    """
+    Sync every tenant in TENANTS_FILE, or only the selected ones, concurrently.
+
+    Parameters:
+    selected (list): Names of the tenants to sync; all of them when empty.
+    dry_run_only (bool): Passed to each tenant's main(), see main.main.
+    execute_only (bool): Passed to each tenant's main(), see main.main.
+
+    Returns:
+    dict: (seconds, errors) for every tenant synced.
+    """
+    tenants = [tenant for tenant in read_tenants(tenants_file) if not selected or tenant['name'] in selected]
+    if not tenants:
+        logging.warning(f"No tenants to sync in {tenants_file}")
+        return {}
+    modules = {tenant['name']: load_tenant(tenant) for tenant in tenants}
+    results = {}
+    with ThreadPoolExecutor(max_workers=tenant_concurrency or len(modules)) as executor:
+        futures = {name: executor.submit(sync_tenant, name, module, dry_run_only, execute_only) for name, module in modules.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.error(f"[{name}] Tenant sync failed: {e}")
+    logging.info("Tenants synced: " + "; ".join(f"{name} {seconds:.1f}s, {errors} errors" for name, (seconds, errors) in results.items()))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync the driver keys of every MyGeotab database in TENANTS_FILE.")
+    parser.add_argument('--tenant', action='append', default=[], help="only sync this tenant, repeatable")
+    parser.add_argument('--dry-run', action='store_true', help="print what would be sent without making any API writes")
+    parser.add_argument('--execute-only', action='store_true', help="only send what is already planned, without fetching or diffing")
+    args = parser.parse_args()
+    main(args.tenant, dry_run_only=args.dry_run, execute_only=args.execute_only)